@@ -1,12 +1,40 @@
+import os
 import re
+import json
+import mmap
+import time
+import socket
+import threading
 import regex
 import copy
+import bisect
+import hashlib
+import importlib.util
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-def translate_sql(q, src='presto', dest='hive', verbose=True):
+def _translate_sql(q, src='presto', dest='hive', timed=False, partition_columns=None, catalog=None, optimize=None,
+                   format='compact'):
     """
-    Translate queries between Presto, Hive and Vertica SQL.
+    Translate one query and return the raw results, i.e. the translated query,
+    the replacements counters, the warnings and the hive session parameters.
+    If timed=True, replacements also records the time spent on each rule.
     """
     
+    if format not in ('raw', 'compact', 'pretty'):
+        raise ValueError("format must be 'raw', 'compact' or 'pretty'.")
+    
+    # Detect the source language if needed: a query which is already in the dest
+    # language is returned as it is, as translating it would be lossy
+    notes = []
+    if src == 'auto':
+        src, confidence = detect_dialect(q)
+        notes.append(f'Note: Source language detected as {src.capitalize()} (confidence {confidence:.2f}).')
+        if src == dest:
+            notes.append('Note: The query is already in the destination language, it was left untranslated.')
+            return q, [], notes, ''
+    
     # 0. Preliminary steps
     
     # Remove inline comments (comments which are always associated with a newline
@@ -18,9 +46,11 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
     
     # Lower text and initialize replacements counter
     q = q.lower()
-    replacements = []
-    warnings = []
+    replacements = _TimedReplacements() if timed else []
+    warnings = notes
     session_parameters = ''
+    partition_columns = _partition_columns(partition_columns)
+    catalog = _schema_catalog(catalog)
     
     # Show warnings if needed
     if ('||' in q) | ('concat_ws' in q) | ('array_join' in q):
@@ -28,6 +58,12 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
     if len(re.findall(r'\b(map|transform|map_from_entries)\b', q)) > 0:
         warnings.append("Warning: Translation doesn't support all Presto mapping functions yet (MAP, TRANSFORM, etc.).")
     
+    # Run the registered rules which come before the built-in ones, if any
+    if timed:
+        replacements.stamp()
+    rules = _compiled_rules[(src, dest)] if (src, dest) in _compiled_rules else _compile_rules(src, dest)
+    q = _apply_rules(q, rules, 0, replacements)
+    
     # 1. From specific languages
     
     if src == 'hive':
@@ -45,11 +81,14 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
         r = r'lateral\s+view\s+explode\s*(\(([\s\S]*?|\w*\s*(\((?>[^()]++|(?2))*\)))\))\s*(\w+)\s+as\s+(\w+)'
         search = regex.findall(r, q)
         col_aliases = [s[4] for s in search]
+        # if we know the column type, that's an array of struct if it's in the schema catalog,
+        # else if the alias is used to access to the struct keys
+        col_kinds = [_column_kind(s[1], catalog) for s in search]
         search = [re.findall(r'{}\.'.format(a), q) for a in col_aliases]
         counter = 0
         counter_realiasing = 0
-        for s in search:
-            if len(s) > 0:
+        for s, kind in zip(search, col_kinds):
+            if kind == 'array of struct' or (kind != 'array' and len(s) > 0):
                 q = regex.sub(r, r'cross join unnest\1 as \5', q, count=1)
                 counter += 1
             else:
@@ -64,8 +103,8 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
         q = regex.sub(r, r'cross join unnest\1 as \4 (\5)', q)
         r = r'lateral\s+view\s+explode\s*(\(([\s\S]*?|\w*\s*(\((?>[^()]++|(?2))*\)))\))\s*(\w+)'
         counter += len(regex.findall(r, q))
-        replacements.append(['lateral view explode -> cross join unnest, for a map', counter])
         q = regex.sub(r, r'cross join unnest\1 as \4 (key, value)', q) # needs to come very last
+        replacements.append(['lateral view explode -> cross join unnest, for a map', counter])
         
         # lateral view outer explode -> left join unnest
         # after translation, I replace with left
@@ -79,32 +118,39 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
             except:
                 continue
             q = before + after
-        replacements.append(['lateral view outer explode -> left join unnest on true', nb_outer])
         # finally add 'on true', for the 3 possible outputs
         search = regex.findall(r'\b(left join unnest\s*)(\(((?>[^()]++|(?2))*)\))*(\s*as\s+\w+(\s*\([\S\s]+?\))*)', q)
         search = [s[0] + s[1] + s[3] for s in search]
         for s in search:
             q = q.replace(s, s + ' on true')
+        replacements.append(['lateral view outer explode -> left join unnest on true', nb_outer])
 
         # pmod -> mod
         r = r'\bpmod\s*\('
-        replacements.append(['pmod -> mod', len(re.findall(r, q))])
-        q = re.sub(r, r'mod(', q)
+        q, subcounter = re.subn(r, r'mod(', q)
+        replacements.append(['pmod -> mod', subcounter])
+        
+        # remove the casts as string of columns which already are strings (if we know it)
+        r = r'\bcast\s*\(\s*([\w."`]+)\s+as\s+string\s*\)'
+        search = [m for m in re.finditer(r, q) if _column_kind(m.group(1), catalog) == 'string']
+        for m in search[::-1]:
+            q = q[:m.start()] + m.group(1) + q[m.end():]
+        replacements.append(['remove cast as string of string columns', len(search)])
         
         # string -> varchar
         r = r'\bstring\b'
-        replacements.append(['string -> varchar', len(re.findall(r, q))])
-        q = re.sub(r, r'varchar', q)
+        q, subcounter = re.subn(r, r'varchar', q)
+        replacements.append(['string -> varchar', subcounter])
         
         # add "" when col name starts with numeric
         r = r'(?<=\s)(\b\d[A-Za-z_]+\b)'
-        replacements.append(['add "" when col name starts with numeric', len(re.findall(r, q))])
-        q = re.sub(r, r'"\1"', q)
+        q, subcounter = re.subn(r, r'"\1"', q)
+        replacements.append(['add "" when col name starts with numeric', subcounter])
         
         # ` -> "
         r = r'`'
-        replacements.append(['` -> "', len(re.findall(r, q))])
-        q = re.sub(r, r'"', q)
+        q, subcounter = re.subn(r, r'"', q)
+        replacements.append(['` -> "', subcounter])
         
         # array() -> array[]
         r = r"(array\b)\s*(\(((?>[^()]++|(?2))*)\))"
@@ -116,13 +162,13 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
         
         # to_date -> date
         r = r'\bto_date\s*\('
-        replacements.append(['to_date() -> date()', len(re.findall(r, q))])
-        q = re.sub(r, r'date(', q)
+        q, subcounter = re.subn(r, r'date(', q)
+        replacements.append(['to_date() -> date()', subcounter])
         
         # add '' to interval quantity (if needed)
         r = r'(?<=\binterval\b\s)(\s*\d+)'
-        replacements.append(["add '' to interval quantity", len(re.findall(r, q))])
-        q = re.sub(r, r"'\1'", q)
+        q, subcounter = re.subn(r, r"'\1'", q)
+        replacements.append(["add '' to interval quantity", subcounter])
         
         # rlike -> regexp_like()
         r = r"(\w+)\s*(\((?>[^()]++|(?2))*\))*\s+(?:rlike)\s+('[\S\s]*')"
@@ -133,59 +179,48 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
         replacements.append(['rlike -> regexp_like()', subcounter])
         
         # extract(part from str) -> extract(part from date)
-        search = regex.findall(r'\b(extract\b)\s*(\(((?>[^()]++|(?2))*)\))*', q)
-        replacements.append(['cast inside of extract() to date', len(search)])
-        search_corrected = [s[2].split('from') for s in search]
-        search_corrected = [' from '.join([search_el[0].strip(' '), 'date(' + search_el[1].strip(' ') + ')']) if 'date(' not in search_el[1] else ' from '.join([search_el[0], search_el[1]]) for search_el in search_corrected]
-        search_corrected = list(zip([s[2] for s in search], search_corrected))
-        for s in search_corrected:
-            q = q.replace(s[0], s[1])
+        def extract_date(name, args):
+            part = re.split(r'\bfrom\b', args[0], 1)
+            if len(args) != 1 or len(part) != 2:
+                return None
+            return f"extract({part[0].strip(' ')} from {_date(part[1], partition_columns, warnings, catalog)})"
+        q, subcounter = _rewrite_calls(q, ['extract'], extract_date)
+        replacements.append(['cast inside of extract() to date', subcounter])
         
         # named_struct -> row, only possible without realiasing the row (as we can't know the data types)
-        search = regex.findall(r"(named_struct\b\s*(\(((?>[^()]++|(?2))*?)\)))", q)
-        if len(search) > 0:
-            nb_newlines = [len(re.findall(r'\n', s[0])) for s in search]
-        # we use the ; trick in case there are functions inside the named_struct, i.e. replace with ; if surrounded by ()
-        search_corrected = [re.sub(r'\(([\s\S]*?),([\s\S]*?)\)', r'(\1;\2)', s[2]) for s in search]
-        names = [s.split(',')[::-2][::-1] for s in search_corrected]
-        names = [[n.replace(';', ',').strip(' ') for n in na] for na in names]
-        trad = ['row(' + ', '.join(n) + ')' for n in names]
-        trad = [t + '\n'*nb_newlines[i] for i, t in enumerate(trad)]
-        for s, t in zip(search, trad):
-            q = q.replace(s[0], t)
-        replacements.append(['named_struct() -> row(), without realiasing', len(search)])
-        if len(search) > 0:
+        # the values are the arguments in odd positions
+        q, subcounter = _rewrite_calls(q, ['named_struct'], lambda name, args: 'row(' + ', '.join(a.strip(' ') for a in args[1::2]) + ')')
+        replacements.append(['named_struct() -> row(), without realiasing', subcounter])
+        if subcounter > 0:
             warnings.append('Warning: When translating from Hive to Presto / Vertica, you cannot use aliases different than the column name for keys in the NAMED_STRUCT.')
 
+        # Registered rules between the common and the specific built-in ones
+        q = _apply_rules(q, rules, 1, replacements)
+        
         # Then, hive specific & presto specific
         if dest == 'presto':            
             
             # unix_timestamp() -> to_unixtime()
             r = r'\bunix_timestamp\s*\('
-            replacements.append(['unix_timestamp() -> to_unixtime()', len(re.findall(r, q))])
-            q = re.sub(r, r'to_unixtime(', q)
+            q, subcounter = re.subn(r, r'to_unixtime(', q)
+            replacements.append(['unix_timestamp() -> to_unixtime()', subcounter])
         
             # size() -> cardinality()
             r = r'\bsize\s*\('
-            replacements.append(['size() -> cardinality()', len(re.findall(r, q))])
-            q = re.sub(r, r'cardinality(', q)
+            q, subcounter = re.subn(r, r'cardinality(', q)
+            replacements.append(['size() -> cardinality()', subcounter])
             
             # map_from_arrays(key, collect_list(value)) -> map_agg(key, value)
-            search = regex.findall(r'\b(map_from_arrays)\s*(\(((?>[^()]++|(?2))*)\))*', q)
-            replacements.append(['map_from_arrays(key, collect_list(value)) -> map_agg(key, value)', len(search)])
-            search2 = [regex.findall(r'\b(collect_list|collect_set)\s*(\(((?>[^()]++|(?2))*)\))*', s[2])[0] for s in search]
-            search_corrected = []
-            for s, s2 in zip(search, search2):
-                sc = 'map_agg(' + ', '.join([s[2].split(',')[0].strip(' '), s2[2]]) + ')'
-                search_corrected.append(sc)
-            search_corrected = list(zip([s[0] + s[1] for s in search], search_corrected))
-            for sc in search_corrected:
-                q = q.replace(sc[0], sc[1])
+            def map_from_arrays(name, args):
+                value = _unwrap_call(args[1], ['collect_list', 'collect_set']) if len(args) == 2 else None
+                return f"map_agg({args[0].strip(' ')}, {value})" if value is not None else None
+            q, subcounter = _rewrite_calls(q, ['map_from_arrays'], map_from_arrays)
+            replacements.append(['map_from_arrays(key, collect_list(value)) -> map_agg(key, value)', subcounter])
             
             # collect_list() -> array_agg()
             r = r'\bcollect_list\s*\('
-            replacements.append(['collect_list() -> array_agg()', len(re.findall(r, q))])
-            q = re.sub(r, r'array_agg(', q)
+            q, subcounter = re.subn(r, r'array_agg(', q)
+            replacements.append(['collect_list() -> array_agg()', subcounter])
             
             # collect_set() -> array_agg(distinct)
             r_window = r'((collect_set\b)\s*(\((?>[^()]++|(?2))*\))[\S\s]+?(over)\s*(\((?>[^()]++|(?2))*\)))'
@@ -200,142 +235,80 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
                     q = q.replace(c, c_translated)
                 replacements.append(['collect_set() -> array_distinct(array_agg() over window)', len(search)])
             # then translate the normal cases
-            replacements.append(['collect_set() -> array_agg(distinct)', len(re.findall(r_collect_set, q))])
-            q = re.sub(r_collect_set, r'array_agg(distinct ', q)
+            q, subcounter = re.subn(r_collect_set, r'array_agg(distinct ', q)
+            replacements.append(['collect_set() -> array_agg(distinct)', subcounter])
             
             # datediff -> date_diff + add unit + cast inside as date
-            # To cast the inside as date we need to split it, but splitting at ',' can be
-            # a problem if the expression includes another function. Actually, we need to
-            # split only if there is no '()' left of the comma -> I use a trick with ';'
-            search = regex.findall(r"\b(datediff\b)\s*(\(((?>[^()]++|(?2))*)\))*", q)
-            replacements.append(['datediff() -> date_diff() + add unit + cast inside as date', len(search)])
-            search_corrected = [re.sub(r'\)\s*,', r');', s[2]) for s in search]
-            search_corrected = [s.split(';') if ';' in s else s.split(',') for s in search_corrected]
-            search_corrected = [', '.join(['date(' + s.strip(' ') + ')' if 'date(' not in s else s.strip(' ') for s in search_el]) for search_el in search_corrected]
-            search_corrected = list(zip([s[2] for s in search], search_corrected))
-            for s in search_corrected:
-                q = q.replace(s[0], s[1])
-            q = re.sub(r'\b(datediff\b)\s*\(', r"date_diff('day', ", q)
+            # The arguments are split on their top-level commas, with the bracket index
+            q, subcounter = _rewrite_calls(q, ['datediff'], lambda name, args: "date_diff('day', " + ', '.join([_date(a, partition_columns, warnings, catalog) for a in args]) + ')')
+            replacements.append(['datediff() -> date_diff() + add unit + cast inside as date', subcounter])
             
             # date_add(str, value) -> date_add('day', value, date)
-            search = regex.findall(r"\b(date_add\b)\s*(\(((?>[^()]++|(?2))*)\))*", q)
-            replacements.append(["date_add(str, value) -> date_add('day', value, date)", len(search)])
-            search_corrected = [re.sub(r'\)\s*,', r');', s[2]) for s in search]
-            search_corrected = [s.split(';') if ';' in s else s.split(',') for s in search_corrected]
-            search_corrected = [', '.join(["'day'", search_el[1].strip(' '), 'date(' + search_el[0].strip(' ') + ')']) if 'date(' not in search_el[0] else ', '.join(["'day'", search_el[1].strip(' '), search_el[0].strip(' ')]) for search_el in search_corrected]
-            search_corrected = list(zip([s[2] for s in search], search_corrected))
-            for s in search_corrected:
-                q = q.replace(s[0], s[1])
+            q, subcounter = _rewrite_calls(q, ['date_add'], lambda name, args: f"date_add('day', {args[1].strip(' ')}, {_date(args[0], partition_columns, warnings, catalog)})" if len(args) == 2 else None)
+            replacements.append(["date_add(str, value) -> date_add('day', value, date)", subcounter])
 
             # date_sub(str, value) -> date_add('day', -value, date)
-            search = regex.findall(r'\b(date_sub\b)\s*(\(((?>[^()]++|(?2))*)\))*', q)
-            replacements.append(["date_sub(str, value) -> date_add('day', -value, date)", len(search)])
-            search_corrected = [re.sub(r'\)\s*,', r');', s[2]) for s in search]
-            search_corrected = [s.split(';') if ';' in s else s.split(',') for s in search_corrected]
-            search_corrected = [', '.join(["'day'", '-' + search_el[1].strip(' '), 'date(' + search_el[0].strip(' ') + ')']) if 'date(' not in search_el[0] else ', '.join(["'day'", '-' + search_el[1].strip(' '), search_el[0].strip(' ')]) for search_el in search_corrected]
-            search_corrected = list(zip([s[2] for s in search], search_corrected))
-            for s in search_corrected:
-                q = q.replace(s[0], s[1])
-            q = re.sub(r'\bdate_sub\s*\(', r'date_add(', q)
+            q, subcounter = _rewrite_calls(q, ['date_sub'], lambda name, args: f"date_add('day', -{args[1].strip(' ')}, {_date(args[0], partition_columns, warnings, catalog)})" if len(args) == 2 else None)
+            replacements.append(["date_sub(str, value) -> date_add('day', -value, date)", subcounter])
             
             # trunc(str, pattern) -> date_format(date, pattern) + warning about different patterns
-            search = regex.findall(r'\b(trunc\b)\s*(\(((?>[^()]++|(?2))*)\))*', q)
-            replacements.append(['trunc(str, pattern) -> date_format(date, pattern)', len(search)])
-            if len(search) > 0:
-                print('Warning: There can be different date string patterns in Presto vs. Hive QL (patterns not translated here).')
-            search_corrected = [re.sub(r'\)\s*,', r');', s[2]) for s in search]
-            search_corrected = [s.split(';') if ';' in s else s.split(',') for s in search_corrected]
-            search_corrected = [', '.join(['date(' + search_el[0].strip(' ') + ')', search_el[1].strip(' ')]) if 'date(' not in search_el[0] else ', '.join([search_el[0].strip(' '), search_el[1].strip(' ')]) for search_el in search_corrected]
-            search_corrected = list(zip([s[2] for s in search], search_corrected))
-            for s in search_corrected:
-                q = q.replace(s[0], s[1])
-            q = regex.sub(r'\btrunc\s*\(', r'date_format(', q)
+            q, subcounter = _rewrite_calls(q, ['trunc'], lambda name, args: f"date_format({_date(args[0], partition_columns, warnings, catalog)}, {args[1].strip(' ')})" if len(args) == 2 else None)
+            replacements.append(['trunc(str, pattern) -> date_format(date, pattern)', subcounter])
+            if subcounter > 0:
+                warnings.append('Warning: There can be different date string patterns in Presto vs. Hive QL (patterns not translated here).')
             
             # percentile_approx() -> approx_percentile()
             r = r'\bpercentile_approx\s*\('
-            replacements.append(['percentile_approx() -> approx_percentile()', len(re.findall(r, q))])
-            q = re.sub(r, r'approx_percentile(', q)
+            q, subcounter = re.subn(r, r'approx_percentile(', q)
+            replacements.append(['percentile_approx() -> approx_percentile()', subcounter])
 
         # Last, hive specific & vertica specific
         if dest == 'vertica':
             
             # unix_timestamp() -> extract(epoch from date)
             r = r'\bunix_timestamp\s*\(\s?'
-            replacements.append(['unix_timestamp() -> extract(epoch from date)', len(re.findall(r, q))])
-            q = re.sub(r, r'extract(epoch from ', q)
+            q, subcounter = re.subn(r, r'extract(epoch from ', q)
+            replacements.append(['unix_timestamp() -> extract(epoch from date)', subcounter])
             
             # size() -> array_length()
             r = r'\bsize\s*\('
-            replacements.append(['size() -> array_length()', len(re.findall(r, q))])
-            q = re.sub(r, r'array_length(', q)
+            q, subcounter = re.subn(r, r'array_length(', q)
+            replacements.append(['size() -> array_length()', subcounter])
             
             # map_from_arrays(key, collect_list(value)) -> mapaggregate(key, value)
-            search = regex.findall(r'\b(map_from_arrays)\s*(\(((?>[^()]++|(?2))*)\))*', q)
-            replacements.append(['map_from_arrays(key, collect_list(value)) -> mapaggregate(key, value)', len(search)])
-            search2 = [regex.findall(r'\b(collect_list|collect_set)\s*(\(((?>[^()]++|(?2))*)\))*', s[2])[0] for s in search]
-            search_corrected = []
-            for s, s2 in zip(search, search2):
-                sc = 'mapaggregate(' + ', '.join([s[2].split(',')[0].strip(' '), s2[2]]) + ')'
-                search_corrected.append(sc)
-            search_corrected = list(zip([s[0] + s[1] for s in search], search_corrected))
-            for sc in search_corrected:
-                q = q.replace(sc[0], sc[1])
+            def map_from_arrays(name, args):
+                value = _unwrap_call(args[1], ['collect_list', 'collect_set']) if len(args) == 2 else None
+                return f"mapaggregate({args[0].strip(' ')}, {value})" if value is not None else None
+            q, subcounter = _rewrite_calls(q, ['map_from_arrays'], map_from_arrays)
+            replacements.append(['map_from_arrays(key, collect_list(value)) -> mapaggregate(key, value)', subcounter])
             
             # collect_list() -> listagg()
             # could use STRING_TO_ARRAY('['||col||']', ',' USING PARAMETERS max_length=1000000) to return an array type
             r = r'\bcollect_list\s*\('
-            replacements.append(['collect_list() -> listagg()', len(re.findall(r, q))])
-            q = re.sub(r, r'listagg(', q)
+            q, subcounter = re.subn(r, r'listagg(', q)
+            replacements.append(['collect_list() -> listagg()', subcounter])
             
             # collect_set() -> listagg(distinct)
             # could use STRING_TO_ARRAY('['||col||']', ',' USING PARAMETERS max_length=1000000) to return an array type
             r = r'\bcollect_set\s*\('
-            replacements.append(['collect_set() -> listagg(distinct)', len(re.findall(r, q))])
-            q = re.sub(r, r'listagg(distinct ', q)
+            q, subcounter = re.subn(r, r'listagg(distinct ', q)
+            replacements.append(['collect_set() -> listagg(distinct)', subcounter])
             
             # datediff -> timestampdiff + add unit + cast inside as date + cast output as date
-            search = regex.findall(r'\b(datediff)\s*(\(((?>[^()]++|(?2))*)\))*', q)
-            replacements.append(['datediff -> timestampdiff + add unit + cast inside and output as date', len(search)])
-            search_corrected = [re.sub(r'\)\s*,', r');', s[2]) for s in search]
-            search_corrected = [s.split(';') if ';' in s else s.split(',') for s in search_corrected]
-            search_corrected = [', '.join(['date(' + s.strip(' ') + ')' if 'date(' not in s else s.strip(' ') for s in search_el]) for search_el in search_corrected]
-            search_corrected = list(zip([s[2] for s in search], search_corrected))
-            for s in search_corrected:
-                q = q.replace(s[0], s[1])
-            q = re.sub(r'\bdatediff\s*\(', r"timestampdiff('day', ", q)
+            q, subcounter = _rewrite_calls(q, ['datediff'], lambda name, args: "timestampdiff('day', " + ', '.join([_date(a, partition_columns, warnings, catalog) for a in args]) + ')')
+            replacements.append(['datediff -> timestampdiff + add unit + cast inside and output as date', subcounter])
 
             # date_add(str, value) -> date(timestampadd('day', value, date))
-            search = regex.findall(r'\b(date_add\b)\s*(\(((?>[^()]++|(?2))*)\))*', q)
-            replacements.append(["date_add(str, value) -> date(timestampadd('day', value, date))", len(search)])
-            search_corrected = [re.sub(r'\)\s*,', r');', s[2]) for s in search]
-            search_corrected = [s.split(';') if ';' in s else s.split(',') for s in search_corrected]
-            search_corrected = [', '.join(["'day'", search_el[1].strip(' '), 'date(' + search_el[0].strip(' ') + ')']) if 'date(' not in search_el[0] else ', '.join(["'day'", search_el[1].strip(' '), search_el[0].strip(' ')]) for search_el in search_corrected]
-            search_corrected = list(zip([s[2] for s in search], search_corrected))
-            for s in search_corrected:
-                q = q.replace(s[0], s[1])
-            q = regex.sub(r'\b(date_add\b)\s*(\(((?>[^()]++|(?2))*)\))*', r'date(timestampadd\2)', q)
+            q, subcounter = _rewrite_calls(q, ['date_add'], lambda name, args: f"date(timestampadd('day', {args[1].strip(' ')}, {_date(args[0], partition_columns, warnings, catalog)}))" if len(args) == 2 else None)
+            replacements.append(["date_add(str, value) -> date(timestampadd('day', value, date))", subcounter])
 
             # date_sub(str, value) -> date(timestampadd('day', -value, date))
-            search = regex.findall(r'\b(date_sub\b)\s*(\(((?>[^()]++|(?2))*)\))*', q)
-            replacements.append(["date_sub(str, value) -> date(timestampadd('day', -value, date))", len(search)])
-            search_corrected = [re.sub(r'\)\s*,', r');', s[2]) for s in search]
-            search_corrected = [s.split(';') if ';' in s else s.split(',') for s in search_corrected]
-            search_corrected = [', '.join(["'day'", '-' + search_el[1].strip(' '), 'date(' + search_el[0].strip(' ') + ')']) if 'date(' not in search_el[0] else ', '.join(["'day'", '-' + search_el[1].strip(' '), search_el[0].strip(' ')]) for search_el in search_corrected]
-            search_corrected = list(zip([s[2] for s in search], search_corrected))
-            for s in search_corrected:
-                q = q.replace(s[0], s[1])
-            q = regex.sub(r'\b(date_sub\b)\s*(\(((?>[^()]++|(?2))*)\))*', r'date(timestampadd\2)', q)
+            q, subcounter = _rewrite_calls(q, ['date_sub'], lambda name, args: f"date(timestampadd('day', -{args[1].strip(' ')}, {_date(args[0], partition_columns, warnings, catalog)}))" if len(args) == 2 else None)
+            replacements.append(["date_sub(str, value) -> date(timestampadd('day', -value, date))", subcounter])
             
             # percentile_approx() -> approximate_percentile()
-            r = r'\b(percentile_approx\b\s*)(\(((?>[^()]++|(?2))*)\))*'
-            search = regex.findall(r, q)
-            search_corrected = [re.sub(r'\(([\s\S]*?),([\s\S]*?)\)', r'(\1;\2)', s[2]) for s in search]
-            expr = [s.split(',')[0].strip(' ').replace(';', ',') for s in search_corrected]
-            perc = [s.split(',')[1].strip(' ') for s in search_corrected]
-            trad = [f'approximate_percentile({e} using parameters percentile={p})' for e, p in zip(expr, perc)]
-            for s, t in zip(search, trad):
-                q = q.replace(s[0]+s[1], t)
-            replacements.append(['percentile_approx() -> approximate_percentile()', len(search)])
+            q, subcounter = _rewrite_calls(q, ['percentile_approx'], lambda name, args: f"approximate_percentile({args[0].strip(' ')} using parameters percentile={args[1].strip(' ')})" if len(args) >= 2 else None)
+            replacements.append(['percentile_approx() -> approximate_percentile()', subcounter])
                 
     if src == 'presto':
         
@@ -343,8 +316,8 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
         
         # 1-indexing -> 0-indexing
         r = r'(?<=\[)(.+?)(?=\])'
-        replacements.append(['1-indexing -> 0-indexing', len(re.findall(r, q))])
-        q = re.sub(r, r'\1-1', q)
+        q, subcounter = re.subn(r, r'\1-1', q)
+        replacements.append(['1-indexing -> 0-indexing', subcounter])
         
         # if needed, just signal that presto interval returns a date, not a timestamp
         if 'interval' in q:
@@ -352,99 +325,95 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
         
         # contains -> array_contains
         r = r'\bcontains\s*\('
-        replacements.append(['contains() -> array_contains()', len(re.findall(r, q))])
-        q = re.sub(r, r'array_contains(', q)
+        q, subcounter = re.subn(r, r'array_contains(', q)
+        replacements.append(['contains() -> array_contains()', subcounter])
+        
+        # Registered rules between the common and the specific built-in ones
+        q = _apply_rules(q, rules, 1, replacements)
         
         # Then, presto specific & vertica specific
         if dest == 'vertica':
             
             # to_unixtime() -> extract(epoch from date)
             r = r'\bto_unixtime\s*\(\s?'
-            replacements.append(['to_unixtime() -> extract(epoch from date)', len(re.findall(r, q))])
-            q = re.sub(r, r'extract(epoch from ', q)
+            q, subcounter = re.subn(r, r'extract(epoch from ', q)
+            replacements.append(['to_unixtime() -> extract(epoch from date)', subcounter])
             
             # cardinality() -> array_length()
             r = r'\bcardinality\s*\('
-            replacements.append(['cardinality() -> array_length()', len(re.findall(r, q))])
-            q = re.sub(r, r'array_length(', q)
+            q, subcounter = re.subn(r, r'array_length(', q)
+            replacements.append(['cardinality() -> array_length()', subcounter])
             
             # array_distinct(array_agg()) -> listagg(distinct)
             # could use STRING_TO_ARRAY('['||col||']', ',' USING PARAMETERS max_length=1000000) to return an array type
             r = r'\barray_distinct[\s\(]+array_agg\s*'
-            replacements.append(['array_distinct(array_agg()) -> listagg(distinct)', len(re.findall(r, q))])
-            q = re.sub(r, r'listagg(distinct ', q)
+            q, subcounter = re.subn(r, r'listagg(distinct ', q)
+            replacements.append(['array_distinct(array_agg()) -> listagg(distinct)', subcounter])
             # could we have more arguments than array_agg inside the array_distinct?
             # if so, then we're most probably in the standalone array_distinct case
             
             # array_agg() -> listagg()
             # could use STRING_TO_ARRAY('['||col||']', ',' USING PARAMETERS max_length=1000000) to return an array type
             r = r'\barray_agg\s*\('
-            replacements.append(['array_agg() -> listagg()', len(re.findall(r, q))])
-            q = re.sub(r, r'listagg(', q)
+            q, subcounter = re.subn(r, r'listagg(', q)
+            replacements.append(['array_agg() -> listagg()', subcounter])
             
             # array_average() -> array_avg()
             r = r'\barray_average\s*\('
-            replacements.append(['array_average() -> array_avg()', len(re.findall(r, q))])
-            q = re.sub(r, r'array_avg(', q)
+            q, subcounter = re.subn(r, r'array_avg(', q)
+            replacements.append(['array_average() -> array_avg()', subcounter])
             
             # array_join() -> ||
             # more complex than expected
             
             # date_diff() -> datediff()
             r = r'\bdate_diff\s*\('
-            replacements.append(['date_diff() -> datediff()', len(re.findall(r, q))])
-            q = re.sub(r, r'datediff(', q)
+            q, subcounter = re.subn(r, r'datediff(', q)
+            replacements.append(['date_diff() -> datediff()', subcounter])
             
             # date_add() -> date(timestampadd())
             r = r'(\bdate_add\b\s*)\s*(\(((?>[^()]++|(?2))*)\))*'
-            replacements.append(['date_add() -> date(timestampadd())', len(regex.findall(r, q))])
-            q = regex.sub(r, r'date(timestampadd\2)', q)
+            q, subcounter = regex.subn(r, r'date(timestampadd\2)', q)
+            replacements.append(['date_add() -> date(timestampadd())', subcounter])
             
             # approx_percentile() -> approximate_percentile()
-            r = r'\b(approx_percentile\b\s*)(\(((?>[^()]++|(?2))*)\))*'
-            search = regex.findall(r, q)
-            search_corrected = [re.sub(r'\(([\s\S]*?),([\s\S]*?)\)', r'(\1;\2)', s[2]) for s in search]
-            expr = [s.split(',')[0].strip(' ').replace(';', ',') for s in search_corrected]
-            perc = [s.split(',')[1].strip(' ') for s in search_corrected]
-            trad = [f'approximate_percentile({e} using parameters percentile={p})' for e, p in zip(expr, perc)]
-            for s, t in zip(search, trad):
-                q = q.replace(s[0]+s[1], t)
-            replacements.append(['approx_percentile() -> approximate_percentile()', len(search)])
+            q, subcounter = _rewrite_calls(q, ['approx_percentile'], lambda name, args: f"approximate_percentile({args[0].strip(' ')} using parameters percentile={args[1].strip(' ')})" if len(args) >= 2 else None)
+            replacements.append(['approx_percentile() -> approximate_percentile()', subcounter])
             
             # map_agg() -> mapaggregate()
             r = r'\bmap_agg\s*\('
-            replacements.append(['map_agg() -> mapaggregate()', len(re.findall(r, q))])
-            q = re.sub(r, r'mapaggregate(', q)
+            q, subcounter = re.subn(r, r'mapaggregate(', q)
+            replacements.append(['map_agg() -> mapaggregate()', subcounter])
 
         # Last, presto specific & hive specific
         if dest == 'hive':
             
             # to_unixtime() -> unix_timestamp()
             r = r'\bto_unixtime\s*\('
-            replacements.append(['to_unixtime() -> unix_timestamp()', len(re.findall(r, q))])
-            q = re.sub(r, r'unix_timestamp(', q)
+            q, subcounter = re.subn(r, r'unix_timestamp(', q)
+            replacements.append(['to_unixtime() -> unix_timestamp()', subcounter])
             
             # cardinality() -> size()
             r = r'\bcardinality\s*\('
-            replacements.append(['cardinality() -> size()', len(re.findall(r, q))])
-            q = re.sub(r, r'size(', q)            
+            q, subcounter = re.subn(r, r'size(', q)
+            replacements.append(['cardinality() -> size()', subcounter])
             
             # array_distinct(array_agg()) -> collect_list(distinct)
             r = r'\barray_distinct[\s\(]+array_agg\s*'
-            replacements.append(['array_distinct(array_agg()) -> collect_list(distinct)', len(re.findall(r, q))])
-            q = re.sub(r, r'collect_list(distinct ', q)
+            q, subcounter = re.subn(r, r'collect_list(distinct ', q)
+            replacements.append(['array_distinct(array_agg()) -> collect_list(distinct)', subcounter])
             # could we have more arguments than array_agg inside the array_distinct?
             # if so, then we're most probably in the standalone array_distinct case
             
             # array_agg() -> collect_list()
             r = r'\barray_agg\s*\('
-            replacements.append(['array_agg() -> collect_list()', len(re.findall(r, q))])
-            q = re.sub(r, r'collect_list(', q)
+            q, subcounter = re.subn(r, r'collect_list(', q)
+            replacements.append(['array_agg() -> collect_list()', subcounter])
             
             # approx_percentile() -> percentile_approx()
             r = r'\bapprox_percentile\s*\('
-            replacements.append(['approx_percentile() -> percentile_approx()', len(re.findall(r, q))])
-            q = re.sub(r, r'percentile_approx(', q)
+            q, subcounter = re.subn(r, r'percentile_approx(', q)
+            replacements.append(['approx_percentile() -> percentile_approx()', subcounter])
 
     if src == 'vertica':  
         
@@ -452,8 +421,8 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
         
         # ifnull -> coalesce
         r = r'\bifnull\s*\('
-        replacements.append(['ifnull -> coalesce', len(re.findall(r, q))])
-        q = re.sub(r, r'coalesce(', q)
+        q, subcounter = re.subn(r, r'coalesce(', q)
+        replacements.append(['ifnull -> coalesce', subcounter])
         
         # zeroifnull(x) -> coalesce(x, 0)
         r = r'\bzeroifnull\b\s*\(([\w\s./\-\+\*]+|\w*\s*(\((?>[^()]++|(?2))*\)))\s*\)'
@@ -473,8 +442,8 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
         
         # bool -> boolean
         r = r'\bbool\b'
-        replacements.append(['bool -> boolean', len(re.findall(r, q))])
-        q = re.sub(r, r'boolean', q)
+        q, subcounter = re.subn(r, r'boolean', q)
+        replacements.append(['bool -> boolean', subcounter])
         
         # :: -> cast
         r = r'([\w\s./\-\+\*]+|\w*\s*(\((?>[^()]++|(?2))*\)))\s*::(\s*\w+)'
@@ -486,8 +455,8 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
         
         # to_timestamp() -> from_unixtime()
         r = r'\bto_timestamp\s*\('
-        replacements.append(['to_timestamp() -> from_unixtime()', len(re.findall(r, q))])
-        q = re.sub(r, r'from_unixtime(', q)
+        q, subcounter = re.subn(r, r'from_unixtime(', q)
+        replacements.append(['to_timestamp() -> from_unixtime()', subcounter])
         
         # remove ilike and consequently insert lower()
         r = r"(\w+)\s*(\((?>[^()]++|(?2))*\))*\s+(ilike)"
@@ -500,35 +469,38 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
         # to_char -> date_format + warning that only works to cast dates as strings 
         # + warning about pattern letters differences
         r = r'\bto_char\s*\('
-        replacements.append(['to_char() -> date_format()', len(re.findall(r, q))])
-        if len(re.findall(r, q)) > 0:
+        q, subcounter = re.subn(r, r'date_format(', q)
+        replacements.append(['to_char() -> date_format()', subcounter])
+        if subcounter > 0:
             warnings.append("Warning: This function can only translate TO_CHAR when it's used to cast a date as a string.")
             warnings.append('Warning: Make sure you use the correct date patterns for your target language.')
-        q = re.sub(r, r'date_format(', q)
+        
+        # Registered rules between the common and the specific built-in ones
+        q = _apply_rules(q, rules, 1, replacements)
         
         # Then, vertica specific & presto specific
         if dest == 'presto':
             
             # extract(epoch from date) -> to_unixtime()
             r = r"\bextract[\s\(]+epoch from\s+"
-            replacements.append(['extract(epoch from date) -> to_unixtime()', len(re.findall(r, q))])
-            q = re.sub(r, r"to_unixtime(", q)
+            q, subcounter = re.subn(r, r"to_unixtime(", q)
+            replacements.append(['extract(epoch from date) -> to_unixtime()', subcounter])
             
             # array_length() -> cardinality()
             r = r'\barray_length\s*\('
-            replacements.append(['array_length() -> cardinality()', len(re.findall(r, q))])
-            q = re.sub(r, r'cardinality(', q)
+            q, subcounter = re.subn(r, r'cardinality(', q)
+            replacements.append(['array_length() -> cardinality()', subcounter])
             
             # listagg() -> array_join(array_agg())
             r = r'\blistagg\s*\('
-            replacements.append(['listagg() -> array_join(array_agg())', len(re.findall(r, q))])
-            q = re.sub(r, r'array_join(array_agg(', q)
+            q, subcounter = re.subn(r, r'array_join(array_agg(', q)
+            replacements.append(['listagg() -> array_join(array_agg())', subcounter])
             #print(    'Note that listagg returns a comma-separated list of strings.')
             
             # array_avg() -> array_average()
             r = r'\array_avg\s*\('
-            replacements.append(['array_avg() -> array_average()', len(re.findall(r, q))])
-            q = re.sub(r, r'array_average(', q)
+            q, subcounter = re.subn(r, r'array_average(', q)
+            replacements.append(['array_avg() -> array_average()', subcounter])
             
             # concat() -> array_join()
             r = r"(concat\b)\s*(\(((?>[^()]++|(?2))*)\))"
@@ -543,117 +515,102 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
             
             # datediff() or timestampdiff() -> date_diff()
             r = r'\b(datediff\b|timestampdiff\b)\s*\('
-            replacements.append(['datediff() or timestampdiff() -> date_diff()', len(re.findall(r, q))])
-            q = re.sub(r, r'date_diff(', q)
+            q, subcounter = re.subn(r, r'date_diff(', q)
+            replacements.append(['datediff() or timestampdiff() -> date_diff()', subcounter])
             
             # timestampadd() -> date_add()
             r = r'\btimestampadd\s*\('
-            replacements.append(['timestampadd() -> date_add()', len(re.findall(r, q))])
-            q = re.sub(r, r'date_add(', q)
+            q, subcounter = re.subn(r, r'date_add(', q)
+            replacements.append(['timestampadd() -> date_add()', subcounter])
 
             # timestamp_trunc() or trunc() -> date_format()
             r = r'\b(timestamp_trunc\b|trunc\b)\s*\('
-            replacements.append(['timestamp_trunc() or trunc() -> date_format()', len(re.findall(r, q))])
-            q = re.sub(r, r'date_format(', q)
+            q, subcounter = re.subn(r, r'date_format(', q)
+            replacements.append(['timestamp_trunc() or trunc() -> date_format()', subcounter])
             if len(re.findall(r, q)) > 0:
                 warnings.append('Warning: Make sure you use the correct date patterns for your target language.')
 
             # date_part() -> date_trunc()
             r = r'\bdate_part\s*\('
-            replacements.append(['date_part() -> date_trunc()', len(re.findall(r, q))])
-            q = re.sub(r, r'date_trunc(', q)
+            q, subcounter = re.subn(r, r'date_trunc(', q)
+            replacements.append(['date_part() -> date_trunc()', subcounter])
             
             # approximate_percentile() -> approx_percentile()
             r = r'approximate_percentile\s*\(([\S\s]+?)using\s*parameters\s*percentile=(0\.\d+)'
-            replacements.append(['approximate_percentile() -> approx_percentile()', len(re.findall(r, q))])
-            q = re.sub(r, r'approx_percentile(\1, \2', q)
+            q, subcounter = re.subn(r, r'approx_percentile(\1, \2', q)
+            replacements.append(['approximate_percentile() -> approx_percentile()', subcounter])
             
             # mapaggregate() -> map_agg()
             r = r'\bmapaggregate\s*\('
-            replacements.append(['mapaggregate() -> map_agg()', len(re.findall(r, q))])
-            q = re.sub(r, r'map_agg(', q)
+            q, subcounter = re.subn(r, r'map_agg(', q)
+            replacements.append(['mapaggregate() -> map_agg()', subcounter])
             
         # Then, vertica specific & hive specific
         if dest == 'hive':
             
             # extract(epoch from date) -> unix_timestamp()
             r = r"\bextract[\s\(]+epoch from\s+"
-            replacements.append(['extract(epoch from date) -> unix_timestamp()', len(re.findall(r, q))])
-            q = re.sub(r, r"unix_timestamp(", q)
+            q, subcounter = re.subn(r, r"unix_timestamp(", q)
+            replacements.append(['extract(epoch from date) -> unix_timestamp()', subcounter])
             
             # array_length() -> size()
             r = r'\barray_length\s*\('
-            replacements.append(['array_length() -> size()', len(re.findall(r, q))])
-            q = re.sub(r, r'size(', q)
+            q, subcounter = re.subn(r, r'size(', q)
+            replacements.append(['array_length() -> size()', subcounter])
             
             # listagg() -> collect_list()
             r = r'\blistagg\s*\('
-            replacements.append(['listagg() -> collect_list()', len(re.findall(r, q))])
-            q = re.sub(r, r'collect_list(', q)
+            q, subcounter = re.subn(r, r'collect_list(', q)
+            replacements.append(['listagg() -> collect_list()', subcounter])
             if len(re.findall(r, q)) > 0:
                 warnings.append('Warning: note that LISTAGG returns a comma-separated list of strings, while COLLECT_LIST in Hive returns an array type.')
             
             # timestamp_trunc() -> trunc()
             r = r'\btimestamp_trunc\s*\('
-            replacements.append(['timestamp_trunc() -> trunc()', len(re.findall(r, q))])
-            q = re.sub(r, r'trunc(', q)
+            q, subcounter = re.subn(r, r'trunc(', q)
+            replacements.append(['timestamp_trunc() -> trunc()', subcounter])
             
             # approximate_percentile() -> percentile_approx()
             r = r'approximate_percentile\s*\(([\S\s]+?)using\s*parameters\s*percentile=(0\.\d+)'
-            replacements.append(['approximate_percentile() -> percentile_approx()', len(re.findall(r, q))])
-            q = re.sub(r, r'percentile_approx(\1, \2', q)
+            q, subcounter = re.subn(r, r'percentile_approx(\1, \2', q)
+            replacements.append(['approximate_percentile() -> percentile_approx()', subcounter])
             
             
     # 2. To specific languages
     
+    q = _apply_rules(q, rules, 2, replacements)
+    
     # presto / vertica common & hive specific
     if dest == 'hive':
         
         # index (this one was hard, it finds back the columns corresponding to the references in group by or order by)
         
         try:
-            print(q)
             # First, get the column expressions
             # We want to get the list of column references only if there is a group by afterwards
             #columns_original = re.findall(r'(?<=\bselect\b)([\S\s]+?)(?=\bfrom\b)', q)
             columns_original = [re.split(r'\bfrom\b', cols)[0] for cols in re.split(r'\bselect\b', q) if re.search(r'\bgroup\b', cols) is not None]
-            # Where to split column expressions? I can replace all commas inside functional expressions
-            # or arrays with a ';', then split on the remaining commas, then replace back the ';' with commas.
-            functions = [[''.join(f) for f in regex.findall(r'(\w+\s*)([\(\[](?>[^()]++|(?2))*[\)\]])+\s*', c)] for c in columns_original]
-            for i in range(len(columns_original)):
-                for f in functions[i]:
-                    columns_original[i] = columns_original[i].replace(f, f.replace(',', ';'))
-            columns_split = [[col.strip() for col in cols.split(',')] for cols in columns_original]
-            columns_split = [[re.sub(r';', r',', col) for col in cols] for cols in columns_split]
+            # Split column expressions on the commas which aren't inside brackets or literals
+            columns_split = [[col.strip() for col in _split_args(cols)] for cols in columns_original]
             # For each column, remove 'as', and remove the last word
             # except if it's alone (no space) or if it includes closing parentheses or brackets 
             # (then it's part of the column expression and should be kept).
             columns_split = [[re.sub(r'\bas\s+?', r'', col) for col in cols] for cols in columns_split]
             columns_split = [[re.sub(r'\s+?[\w^\)^\]]+\s*$', r'', col) for col in cols] for cols in columns_split]
 
-            # Then, get the group by and order by expressions. We use the same trick as before
-            # to split them, except that we keep the spaces and newlines.
+            # Then, get the group by and order by expressions. We split them the same way
+            # as before, except that we keep the spaces and newlines.
             groupby_original = regex.findall(r'(?<=group by)([\S\s]+?)(?=order\s+by|having|select|union|limit|$|\)\s*\w+|\s+,\s+\w+\s+as)', q)
             if len(groupby_original) > 0:
                 groupby_original = [groupby_original[0]]
             groupby_split = copy.deepcopy(groupby_original)
-            functions = [[''.join(f) for f in regex.findall(r'(\w+\s*)([\(\[](?>[^()]++|(?2))*[\)\]])+\s*', c)] for c in groupby_split]
-            for i in range(len(groupby_split)):
-                for f in functions[i]:
-                    groupby_split[i] = groupby_split[i].replace(f, f.replace(',', ';'))
-            groupby_split = [cols.split(',') for cols in groupby_split]
-            groupby_split = [[re.sub(r';', r',', col) for col in cols] for cols in groupby_split]
+            groupby_split = [_split_args(cols) for cols in groupby_split]
 
             orderby_original = regex.findall(r'(?<=order by)([\S\s]+?)(?=select|union|limit|$|\)\s*\w+|\s+,\s+\w+\s+as)', q)
             if len(orderby_original) > 0:
                 orderby_original = [orderby_original[0]]
             orderby_split = copy.deepcopy(orderby_original)
-            functions = [[''.join(f) for f in regex.findall(r'(\w+\s*)([\(\[](?>[^()]++|(?2))*[\)\]])+\s*', c)] for c in orderby_split]
-            for i in range(len(orderby_split)):
-                for f in functions[i]:
-                    orderby_split[i] = orderby_split[i].replace(f, f.replace(',', ';'))
-            orderby_split = [cols.split(',') for cols in orderby_split]
-            orderby_split = [[re.sub(r';', r',', col) for col in cols] for cols in orderby_split]
+            orderby_split = [_split_args(cols) for cols in orderby_split]
 
             # Remove the column references that have been commented out
             columns_split = [[t for t in cols if not (t.strip(' ').startswith('/*') or t.strip().endswith('*/'))] for cols in columns_split]
@@ -716,21 +673,29 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
         
         # unnest an array, presto -> hive, with realiasing
         r = r'cross\s+join\s+unnest\s*(\(([\s\S]*?|\w*\s*(\((?>[^()]++|(?2))*\)))\))\s*(as)*\s+(\w+)\s*\((\w+)\)'
-        replacements.append(['cross join unnest -> lateral view explode, for an array, with realiasing', len(regex.findall(r,q))])
-        q = regex.sub(r, r'lateral view explode\1 \5 as \6', q)
+        q, subcounter = regex.subn(r, r'lateral view explode\1 \5 as \6', q)
+        replacements.append(['cross join unnest -> lateral view explode, for an array, with realiasing', subcounter])
         # unnest an array of struct, presto -> hive, with realiasing
         # realiasing an array of struct is not possible in Hive -> if there are several elements in the presto realiasing, display a warning
         r = r'cross\s+join\s+unnest\s*(\(([\s\S]*?|\w*\s*(\((?>[^()]++|(?2))*\)))\))\s*(as)*\s+(\w+)\s*\((\s*.*\s*,\s*.*\s*)\)' #2 or more realiased elements
         if len(regex.findall(r, q)) > 0:
             warnings.append("Warning: If you unnest an array of struct, you cannot re-alias the key names of the struct in Hive's LATERAL VIEW.")
 
+        # unnest a map, presto -> hive, without realiasing, if the schema catalog tells it's a map
+        r = r'cross\s+join\s+unnest\s*(\(([\s\S]*?|\w*\s*(\((?>[^()]++|(?2))*\)))\))\s*(as)*\s+(\w+)(?!\s*\()'
+        search = [s for s in regex.findall(r, q) if _column_kind(s[1], catalog) == 'map']
+        for s in search:
+            q = regex.sub(r'cross\s+join\s+unnest\s*' + regex.escape(s[0]) + r'\s*(as)*\s+' + s[4] + r'\b',
+                          'lateral view explode' + s[0].replace('\\', '\\\\') + ' ' + s[4] + ' as key, value', q, count=1)
+        replacements.append(['cross join unnest -> lateral view explode, for a map, without realiasing', len(search)])
+        
         # unnest an array of struct or an array, presto -> hive, without realiasing
         r = r'cross\s+join\s+unnest\s*(\(([\s\S]*?|\w*\s*(\((?>[^()]++|(?2))*\)))\))\s*(as)*\s+(\w+)'
         search = regex.findall(r, q)
-        replacements.append(['cross join unnest -> lateral view explode, for an array or array of struct, without realiasing', len(search)])
         q = regex.sub(r, r'lateral view explode\1 t_ as \5', q)
+        replacements.append(['cross join unnest -> lateral view explode, for an array or array of struct, without realiasing', len(search)])
         # add a warning to cover the case when the map isn't correctly realiased in presto, i.e. unable to distinguish whether we're unnesting a map or an array of struct
-        if len(search) > 0:
+        if len([s for s in search if _column_kind(s[1], catalog) is None]) > 0:
             warnings.append("Warning: Note that if you're unnesting a map (i.e. an array of pairs), you need to re-alias it in your base query with the following syntax, else it will not be correctly translated: cross join unnest (col_name) as col_alias (key, value).")
         # note that in the case above, new_column.* works in presto but not in hive -> we'll add a warning if we find such syntax
         col_aliases = [s[4] for s in search]
@@ -741,8 +706,8 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
         
         # unnest a map, presto -> hive, with realiasing
         r = r'cross\s+join\s+unnest\s*(\(([\s\S]*?|\w*\s*(\((?>[^()]++|(?2))*\)))\))\s*(as)*\s+(\w+)\s*\((\s*\w+\s*,\s*\w+\s*)\)' #exactly 2 realiased elements
-        replacements.append(['cross join unnest -> lateral view explode, for a map, with realiasing', len(regex.findall(r, q))])
-        q = regex.sub(r, r'lateral view explode\1 \5 as \6', q)
+        q, subcounter = regex.subn(r, r'lateral view explode\1 \5 as \6', q)
+        replacements.append(['cross join unnest -> lateral view explode, for a map, with realiasing', subcounter])
         # unnest a map, presto -> hive, without realiasing
         # actually, this case would have already been replaced by the array of struct case without realiasing
         # i.e. 'lateral view explode (original_column) t as new_column', so I added a warning above
@@ -762,24 +727,33 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
             except:
                 continue
             q = before + after
-        replacements.append(['left join unnest on true -> lateral view outer explode', nb_left])
         # finally drop 'on true'
         q = re.sub(r'on\s+true(\s+)', r'\1', q)
+        replacements.append(['left join unnest on true -> lateral view outer explode', nb_left])
 
         # mod -> pmod
         r = r'\bmod\s*\('
-        replacements.append(['mod -> pmod', len(re.findall(r, q))])
-        q = re.sub(r, r'pmod(', q)
+        q, subcounter = re.subn(r, r'pmod(', q)
+        replacements.append(['mod -> pmod', subcounter])
+        
+        # remove the casts as varchar of string columns (if we know it) which can't truncate them,
+        # i.e. without length, or with a length at least as long as the column's varchar length
+        r = r'\bcast\s*\(\s*([\w."`]+)\s+as\s+varchar\s*(?:\(\s*(\d+)\s*\))?\s*\)'
+        search = [m for m in re.finditer(r, q) if _column_kind(m.group(1), catalog) == 'string'
+                  and (m.group(2) is None or int(m.group(2)) >= (_varchar_length(catalog.column_type(m.group(1))) or float('inf')))]
+        for m in search[::-1]:
+            q = q[:m.start()] + m.group(1) + q[m.end():]
+        replacements.append(['remove cast as varchar of string columns which fit in it', len(search)])
         
         # varchar -> string, only when varchar length isn't specified
         r = r'\bvarchar(?!\s*\()'
-        replacements.append(["varchar -> string, only when varchar length isn't specified", len(re.findall(r, q))])
-        q = re.sub(r, r'string', q)
+        q, subcounter = re.subn(r, r'string', q)
+        replacements.append(["varchar -> string, only when varchar length isn't specified", subcounter])
         
         # " -> `
         r = r'"'
-        replacements.append(['" -> `', len(re.findall(r, q))])
-        q = re.sub(r, r'`', q)
+        q, subcounter = re.subn(r, r'`', q)
+        replacements.append(['" -> `', subcounter])
         
         # array[] -> array()        
         r = r"(\barray\b)\s*(\[([\S\s]*?)\])"
@@ -791,164 +765,118 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
         
         # date -> to_date
         r = r'\bdate\s*\('
-        replacements.append(['date() -> to_date()', len(re.findall(r, q))])
-        q = re.sub(r, r'to_date(', q)
+        q, subcounter = re.subn(r, r'to_date(', q)
+        replacements.append(['date() -> to_date()', subcounter])
         
         # datediff() or date_diff() or timestampdiff() -> datediff() + remove unit + reverse output
-        # split the expression(s) into parts
-        search = regex.findall(r'\b(datediff|date_diff|timestampdiff)\s*(\(((?>[^()]++|(?2))*)\))*', q)
-        replacements.append(['datediff() or date_diff() or timestampdiff() -> datediff() + remove unit + reverse output', len(search)])
-        if len(search) > 0:
+        # i.e. remove the first argument (the unit), when there is one
+        q, subcounter = _rewrite_calls(q, ['datediff', 'date_diff', 'timestampdiff'], lambda name, args: '-datediff(' + ','.join(args[1:]).strip(' ') + ')' if len(args) == 3 else None)
+        replacements.append(['datediff() or date_diff() or timestampdiff() -> datediff() + remove unit + reverse output', subcounter])
+        if subcounter > 0:
             warnings.append('Warning: In Hive, you can only add or remove days (no other units).')
-        # look for the inside of the brackets (2nd element) and remove the first element (the unit)
-        # also keep the original and use this tuple (old, new) to run a replacement
-        search = [(s[1], '(' + ','.join(s[1].split(',')[1:]).strip(' ')) for s in search]
-        for s in search:
-            q = q.replace(s[0], s[1])
-        q = re.sub(r'\b(datediff\b|date_diff\b|timestampdiff\b)\s*\(', r'-datediff(', q)
         
         # timestampadd or date_add(unit_str, value, date) -> date_add(date, value)
-        search = re.findall(r"(\bdate_add\s*\('\w+',\s*|timestampadd\s*\('\w+',\s*)", q)
-        replacements.append(['timestampadd or date_add(unit_str, value, date) -> date_add(date, value)', len(search)])
-        # display warning if necessary (i.e. if other units than 'day' are used)
-        if len(search) > 0:
-            for s in search:
-                s2 = re.findall(r"(\b(date_add\b|timestampadd\b)\s*\()'day',\s*", s)
-                if len(s2) == 0:
-                    warnings.append('Warning: In Hive, you can only add or remove days (no other units).')
-                    break
-        # start by removing the unit
-        q = re.sub(r"(\b(date_add\b|timestampadd\b)\s*\()'\w+',\s*", r'\1', q)
-        # then split elements and invert them
-        search = regex.findall(r"\b(date_add\b|timestampadd\b)\s*(\(((?>[^()]++|(?2))*)\))*", q)
-        search_corrected = [re.sub(r'\)\s*,', r');', s[2]) for s in search]
-        search_corrected = [s.split(';') if ';' in s else s.split(',') for s in search_corrected]
-        search_corrected = [', '.join([search_el[1].strip(' '), search_el[0].strip(' ')]) for search_el in search_corrected]
-        search_corrected = list(zip([s[2] for s in search], search_corrected))
-        for s in search_corrected:
-            q = q.replace(s[0], s[1])
-        # finally rename the function
-        q = re.sub(r'\btimestampadd\s*\(', r'date_add(', q)
+        def date_add(name, args):
+            if len(args) != 3:
+                return None
+            # display warning if necessary (i.e. if other units than 'day' are used)
+            if args[0].strip(' \'') != 'day':
+                warnings.append('Warning: In Hive, you can only add or remove days (no other units).')
+            return f"date_add({args[2].strip(' ')}, {args[1].strip(' ')})"
+        q, subcounter = _rewrite_calls(q, ['date_add', 'timestampadd'], date_add)
+        replacements.append(['timestampadd or date_add(unit_str, value, date) -> date_add(date, value)', subcounter])
         
         # date_part or date_trunc(part, date) -> extract(part from date) (or trunc(date, 'PART'))
-        search = regex.findall(r'\b(date_part\b|date_trunc\b)\s*(\(((?>[^()]++|(?2))*)\))*', q)
-        replacements.append(['date_part or date_trunc(part, date) -> extract(part from date)', len(search)])
-        search_corrected = [s[2].split(',') for s in search]
-        search_corrected = [[search_el[0], ','.join(search_el[1:])] for search_el in search_corrected]
-        search_corrected = [' from '.join([search_el[0].strip(' '), search_el[1].strip(' ')]) for search_el in search_corrected]
-        search_corrected = list(zip([s[2] for s in search], search_corrected))
-        for s in search_corrected:
-            q = q.replace(s[0], s[1])
-        q = re.sub(r'\b(date_part\b|date_trunc\b)\s*\(', r'extract(', q)
+        q, subcounter = _rewrite_calls(q, ['date_part', 'date_trunc'], lambda name, args: f"extract({args[0].strip(' ')} from {','.join(args[1:]).strip(' ')})" if len(args) >= 2 else None)
+        replacements.append(['date_part or date_trunc(part, date) -> extract(part from date)', subcounter])
         
         # row with realiasing -> named_struct
-        search = regex.findall(r'(cast\s*\(\s*row\s*(\(((?>[^()]++|(?2))*?)\))\s*as\s+row\s*\(((?>[^()]++|(?2))*?)\)\s*\))', q)
-        if len(search) > 0:
-            nb_newlines = [len(re.findall(r'\n', s[0])) for s in search]
-        names_corrected = [re.sub(r'\(([\s\S]*?),([\s\S]*?)\)', r'(\1;\2)', s[2]).split(',') for s in search]
-        names = [[n.replace(';', ',').strip(' ') for n in na] for na in names_corrected]
-        alias = [[a.strip(' ').split(' ')[0] for a in s[3].split(',')] for s in search]
-        trad = ['named_struct(' + ', '.join([f"'{a}', {n}" for a, n in zip(al, na)]) + ')' for al, na in zip(alias, names)]
-        trad = [t + '\n'*nb_newlines[i] for i, t in enumerate(trad)]
-        for s, t in zip(search, trad):
-            q = q.replace(s[0], t)
-        replacements.append(['row() with realiasing -> named_struct()', len(search)])
+        def named_struct(name, args):
+            m = re.fullmatch(r'\s*(row\s*\([\s\S]*\))\s+as\s+row\s*\(([\s\S]*)\)\s*', args[0]) if len(args) == 1 else None
+            values = _unwrap_call(m.group(1), ['row']) if m is not None else None
+            if values is None:
+                return None
+            names = [n.strip(' ') for n in _split_args(values)]
+            alias = [a.strip(' ').split(' ')[0] for a in _split_args(m.group(2))]
+            return 'named_struct(' + ', '.join([f"'{a}', {n}" for a, n in zip(alias, names)]) + ')'
+        q, subcounter = _rewrite_calls(q, ['cast'], named_struct)
+        replacements.append(['row() with realiasing -> named_struct()', subcounter])
 
         # row without realiasing -> named_struct
-        search = regex.findall(r'(row\b\s*(\(((?>[^()]++|(?2))*?)\)))', q)
-        if len(search) > 0:
-            nb_newlines = [len(re.findall(r'\n', s[0])) for s in search]
-        names_corrected = [re.sub(r'\(([\s\S]*?),([\s\S]*?)\)', r'(\1;\2)', s[2]).split(',') for s in search]
-        names = [[n.replace(';', ',').strip(' ') for n in na] for na in names_corrected]
-        trad = ['named_struct(' + ', '.join([f"'{name}', {name}" for name in t]) + ')' for t in names]
-        trad = [t + '\n'*nb_newlines[i] for i, t in enumerate(trad)]
-        for s, t in zip(search, trad):
-            q = q.replace(s[0], t)
-        replacements.append(['row() without realiasing -> named_struct()', len(search)])
+        q, subcounter = _rewrite_calls(q, ['row'], lambda name, args: 'named_struct(' + ', '.join([f"'{n.strip(' ')}', {n.strip(' ')}" for n in args]) + ')')
+        replacements.append(['row() without realiasing -> named_struct()', subcounter])
         
         # mapaggregate(key, value) or map_agg(key, value) -> map_from_arrays(key, collect_list(value))
-        search = regex.findall(r'\b(map_agg|mapaggregate)\s*(\(((?>[^()]++|(?2))*)\))*', q)
-        replacements.append(['mapaggregate/map_agg(key, value) -> map_from_arrays(key, collect_list(value))', len(search)])
-        search_corrected = []
-        for s in search:
-            sc = 'map_from_arrays(' + s[2].split(',')[0].strip(' ') + ', collect_list(' + ','.join(s[2].split(',')[1:]).strip(' ') + '))'
-            search_corrected.append(sc)
-        search_corrected = list(zip([s[0] + s[1] for s in search], search_corrected))
-        for sc in search_corrected:
-            q = q.replace(sc[0], sc[1])
+        q, subcounter = _rewrite_calls(q, ['map_agg', 'mapaggregate'], lambda name, args: f"map_from_arrays({args[0].strip(' ')}, collect_list({','.join(args[1:]).strip(' ')}))" if len(args) >= 2 else None)
+        replacements.append(['mapaggregate/map_agg(key, value) -> map_from_arrays(key, collect_list(value))', subcounter])
                 
     # hive / vertica common & presto specific
     if dest == 'presto':
         
-        # cast division as float
-        r = r'/'
-        replacements.append(['cast division as float', len(re.findall(r, q))])
-        q = re.sub(r, r'*1.0000 /', q)
+        # cast division as float, except for the / in literals or comments, and for
+        # the divisions which already are floating-point (literal or column type)
+        q, subcounter = _cast_division(q, catalog)
+        replacements.append(['cast division as float', subcounter])
         # this actually isn't enough to cast one member of the division as double, but 4 decimals should be enough for most cases
         
         # 0-indexing -> 1-indexing
         r = r'(?<=\[)(.+?)(?=\])'
-        replacements.append(['0-indexing -> 1-indexing', len(re.findall(r, q))])
-        q = re.sub(r, r'\1+1', q)
+        q, subcounter = re.subn(r, r'\1+1', q)
+        replacements.append(['0-indexing -> 1-indexing', subcounter])
     
-        # add date() when interval is used
-        r = r'''(=)([\S\s]+\binterval\b[\s'"\d]+[\w]+)'''
-        replacements.append(['add date() when interval is used', len(re.findall(r, q))])
-        q = re.sub(r, r'= date(\2)', q)
+        # add date() when interval is used, around the right-hand operand of the comparison
+        # which holds the interval, i.e. without crossing another comparison, a boolean
+        # operator, a clause or an unbalanced bracket
+        r = r'''=((?:(?!\b(?:and|or|where|on|having|when|then|else|group|order|limit)\b)(?:'[^']*'|(\((?>[^()]++|(?2))*\))|[^=()'<>!]))+?\binterval\b[\s'"\d]+\w+)'''
+        q, subcounter = regex.subn(r, lambda m: '= ' + _date_literal(m.string[:m.start()], m.group(1), partition_columns, warnings), q)
+        replacements.append(['add date() when interval is used', subcounter])
         
         # array_contains() -> contains()
         r = r'\barray_contains\s*\('
-        replacements.append(['array_contains() -> contains()', len(re.findall(r, q))])
-        q = re.sub(r, r'contains(', q)
+        q, subcounter = re.subn(r, r'contains(', q)
+        replacements.append(['array_contains() -> contains()', subcounter])
         
     # hive / presto common & vertica specific
     if dest == 'vertica':
         
         # from_unixtime() -> to_timestamp()
         r = r'\bfrom_unixtime\s*\('
-        replacements.append(['from_unixtime() -> to_timestamp()', len(re.findall(r, q))])
-        q = re.sub(r, r'to_timestamp(', q)
+        q, subcounter = re.subn(r, r'to_timestamp(', q)
+        replacements.append(['from_unixtime() -> to_timestamp()', subcounter])
         
         # if -> case when
         # I split the members of the IF in order to change the syntax
-        searched = regex.findall(r'(if\s*)(\(((?>[^()]++|(?2))*)\))', q)
-        joined = [''.join(t[:2]) for t in searched]
-        modified = [t[-1].split(',') for t in searched]
-        modified = [f'case when {t[0]} then {t[1]} else {t[2]} end'.replace('  ', ' ') for t in modified]
-        for i in range(len(joined)):
-            q = q.replace(joined[i], modified[i])
-        replacements.append(['if -> case when', len(searched)])
+        q, subcounter = _rewrite_calls(q, ['if'], lambda name, args: f'case when {args[0]} then {args[1]} else {args[2]} end'.replace('  ', ' ') if len(args) == 3 else None)
+        replacements.append(['if -> case when', subcounter])
         
         # date_format() -> to_char() + cast as date + warning about pattern letters differences
         r = r'(\bdate_format\b\s*)\s*(\(((?>[^()]++|(?2))*)\))*'
         if len(regex.findall(r, q)) > 0:
             warnings.append('Warning: Make sure you use the correct date patterns for your target language.')
-        replacements.append(['date_format() -> to_char() + cast as date', len(regex.findall(r, q))])
-        q = regex.sub(r, r'date(to_char\2)', q)
+        q, subcounter = regex.subn(r, r'date(to_char\2)', q)
+        replacements.append(['date_format() -> to_char() + cast as date', subcounter])
+    
+    # Performance hints: cheaper equivalents in the dest language, if asked
+    if optimize is not None:
+        q = _optimize(q, dest, optimize, replacements, warnings)
     
     # 3. Final results
     
-    # Format a few things:
-    # Put capital letters to functions and SQL commands
-    r = r'''(\b\w+\s*\(|(?<!\.)\b(select|from|where|group by|order by|union|all|intersect|interval|left|right|inner|join|cross|unnest|lateral|view|explode|between|in|as|or|and|with|set|having|limit|outer|like|ilike|rlike|is|not|null|partition|by|over|on|case|when|then|else|end|preceding|following|date|timestamp|varchar|double|int|integer|string|bool|boolean|bigint|smallint|tinyint|float|insert|desc|asc|distinct|using|parameters|create table|drop table|if exists|ordinality)\b)'''
-    q = re.sub(r, lambda m: f"{m.group(1).upper()}", q)
-    # Add spaces after commas 
-    r = r',[ ]*'
-    q = re.sub(r, r', ', q)
-    # Remove spaces before closing parentheses
-    r = r'([^\s])[ ]\)'
-    q = re.sub(r, r'\1)', q)
-    
-    # Replace back inline comments, at the correct position
-    def replace_nth(s, old, new, n):
-        where = [m.start() for m in re.finditer(old, s)][n]
-        before = s[:where]
-        after = s[where:]
-        after = after.replace(old, new, 1)
-        s = before + after
-        return s
-    for i in range(len(newlines)):
-        q = replace_nth(q, newlines[i], newlines_and_comments[i], i)
+    q = _apply_rules(q, rules, 3, replacements)
+    
+    # Format a few things, in one pass which leaves literals alone (see _format):
+    # capital letters for functions and SQL commands, spaces after commas and
+    # no spaces before closing parentheses
+    if format != 'raw':
+        q = _format(q)
+    
+    q = _apply_rules(q, rules, 4, replacements)
+    
+    # Replace back inline comments, at the correct position: the n-th newline
+    # character gets back its comment, and newlines added by the rewrites are kept
+    lines = q.split('\n')
+    comments = newlines_and_comments[:len(newlines)]
+    q = lines[0] + ''.join(c + line for c, line in zip(comments, lines[1:])) + ''.join('\n' + line for line in lines[len(comments) + 1:])
     # the try-except below manages the case when the string ends with a comment
     try:
         if newlines_and_comments[-1][-1] != '\n':
@@ -956,25 +884,1501 @@ def translate_sql(q, src='presto', dest='hive', verbose=True):
     except:
         pass
     
+    # Lay out the query for human review, now that the comments are back
+    if format == 'pretty':
+        q = _pretty(q)
+    if timed:
+        replacements.stamp()
+    
+    return q, replacements, warnings, session_parameters
+
+
+def translate_sql(q, src='presto', dest='hive', verbose=True, metrics=None, partition_columns=None, catalog=None,
+                  optimize=None, format='compact'):
+    """
+    Translate queries between Presto, Hive and Vertica SQL.
+    If src='auto', the source language is detected from the query (see detect_dialect).
+    If metrics (a TranslationMetrics) is given, rule hits, warnings and latencies are recorded.
+    If partition_columns is given (see load_partition_columns), rewrites avoid wrapping
+    these columns in functions, which would prevent partition pruning.
+    If catalog (a SchemaCatalog or the path of its snapshot) is given, type-dependent
+    rewrites only add casts where the column types require them.
+    If optimize is 'propose' or 'apply', cheaper equivalents in the dest language
+    (e.g. approximate aggregations) are suggested as hints, or applied.
+    format is 'compact' (capital letters for keywords and functions, spaces after commas),
+    'pretty' (same, with one line per clause and indented subqueries) or 'raw' (as rewritten).
+    """
+    
+    if metrics is not None:
+        # record the detected source language rather than 'auto'
+        observed_src = detect_dialect(q)[0] if src == 'auto' else src
+        t = time.perf_counter()
+        q, replacements, warnings, session_parameters = _translate_sql(q, src, dest, timed=True, partition_columns=partition_columns, catalog=catalog,
+                                                                       optimize=optimize, format=format)
+        metrics.observe(observed_src, dest, replacements, warnings, time.perf_counter() - t)
+    else:
+        q, replacements, warnings, session_parameters = _translate_sql(q, src, dest, partition_columns=partition_columns, catalog=catalog,
+                                                                       optimize=optimize, format=format)
+    
     # Build result string
     if verbose:
-        # delete replacement information when 0 replacements
-        replacements = [r for r in replacements if r[1] != 0]
-        # delete duplicate warnings
-        warnings = list(set(warnings))
-        # print warnings
-        results = '\n'.join(warnings)
-        if len(warnings) > 0:
-            results += '\n\n'
-        # print replacements in a nice format
-        if len(replacements) > 1:
-            w = 'replacements'
-        else:
-            w = 'replacement'
-        results += f'{sum([r[1] for r in replacements])} {w} in total:\n'
-        replacements = '\n'.join([f'  • {r[0]}:  {r[1]}' for r in replacements])
-        results += replacements
+        results = _format_report(replacements, warnings)
     else:
         results = ''
         
-    return results + '\n\n' + session_parameters + q
\ No newline at end of file
+    return results + '\n\n' + session_parameters + q
+
+
+def _format_report(replacements, warnings):
+    """
+    Build the warnings and replacements report displayed above the query.
+    """
+    
+    # delete replacement information when 0 replacements
+    replacements = [r for r in replacements if r[1] != 0]
+    # delete duplicate warnings
+    warnings = list(dict.fromkeys(warnings))
+    # print warnings
+    results = '\n'.join(warnings)
+    if len(warnings) > 0:
+        results += '\n\n'
+    # print replacements in a nice format
+    if len(replacements) > 1:
+        w = 'replacements'
+    else:
+        w = 'replacement'
+    results += f'{sum([r[1] for r in replacements])} {w} in total:\n'
+    replacements = '\n'.join([f'  • {r[0]}:  {r[1]}' for r in replacements])
+    results += replacements
+    return results
+
+
+# SQL commands and types written in capital letters
+_keywords = ('select|from|where|group by|order by|union|all|intersect|interval|left|right|inner|join|cross|unnest|lateral|view|'
+             'explode|between|in|as|or|and|with|set|having|limit|outer|like|ilike|rlike|is|not|null|partition|by|over|on|case|'
+             'when|then|else|end|preceding|following|date|timestamp|varchar|double|int|integer|string|bool|boolean|bigint|'
+             'smallint|tinyint|float|insert|desc|asc|distinct|using|parameters|create table|drop table|if exists|ordinality')
+
+
+def _alternation(words):
+    """
+    Regex alternation of words, factored by prefix (e.g. 'a(?:l(?:l)|n(?:d)|s(?:c)?)' for all,
+    and, as, asc), so that it fails after one character at most positions.
+    """
+    
+    prefixes = {}
+    for w in words:
+        prefixes.setdefault(w[:1], []).append(w[1:])
+    alternatives = []
+    for c, ends in sorted(prefixes.items()):
+        if c == '':
+            continue
+        rest = _alternation(ends)
+        if rest == '':
+            alternatives.append(re.escape(c))
+        else:
+            alternatives.append(re.escape(c) + '(?:' + rest + ')' + ('?' if '' in ends else ''))
+    return '|'.join(alternatives)
+
+
+# Tokens which matter for the formatting, in one alternation: literals, quoted identifiers
+# and comments (kept as they are), function names, keywords, commas not followed by
+# exactly one space and spaces before ')'
+_format_tokens = re.compile(r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`|/\*[\s\S]*?\*/|--[^\n]*"""
+                            r'|\b\w+\s*\(|(?<!\.)\b(?:' + _alternation(_keywords.split('|')) + r')\b|,(?! [^ )])[ ]*\)?|(?<=\S) \)')
+
+
+def _format_token(m):
+    token = m.group()
+    if token[0] in '\'"`/-':
+        return token
+    if token[0] == ',':
+        return ',)' if token[-1] == ')' else ', '
+    return token.upper().lstrip(' ')
+
+
+def _format(q):
+    """
+    Format a query: capital letters for functions and SQL commands, spaces after
+    commas and no spaces before closing parentheses, outside of literals.
+    """
+    
+    return _format_tokens.sub(_format_token, q)
+
+
+# Tokens of the pretty layout: literals, comments, clause keywords, then anything else
+_pretty_tokens = re.compile(r"""(\s*)('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`|/\*[\s\S]*?\*/|--[^\n]*"""
+                            r'|(?<![.\w])(?:select|from|where|group\s+by|having|order\s+by|limit|union(?:\s+all)?|intersect'
+                            r'|(?:(?:left|right|full)(?:\s+outer)?\s+|inner\s+|cross\s+)?join|lateral\s+view(?:\s+outer)?)\b'
+                            r'|\w+|\S)', re.I)
+_clause_keywords = re.compile(r'(?:select|from|where|group\s+by|having|order\s+by|limit|union(?:\s+all)?|intersect'
+                              r'|(?:(?:left|right|full)(?:\s+outer)?\s+|inner\s+|cross\s+)?join|lateral\s+view(?:\s+outer)?)$', re.I)
+
+
+def _pretty(q, indent='    '):
+    """
+    Lay out a formatted query for human review: one line per clause, one line per
+    selected column, and subqueries indented by their depth. The whitespace between
+    tokens is collapsed, except after comments.
+    """
+    
+    out = []
+    # for each open bracket, whether it holds a subquery
+    brackets = []
+    clause = None
+    newline = False
+    tokens = [(m.group(1), m.group(2)) for m in _pretty_tokens.finditer(q)]
+    for i, (space, token) in enumerate(tokens):
+        level = sum(brackets)
+        query_level = len(brackets) == 0 or brackets[-1]
+        if _clause_keywords.match(token) and query_level:
+            token = re.sub(r'\s+', ' ', token)
+            clause = token.lower()
+            out.append(('\n' + indent * level if len(out) > 0 else '') + token)
+            newline = clause == 'select'
+            continue
+        if token == ')' and len(brackets) > 0 and brackets.pop():
+            out.append('\n' + indent * (level - 1) + token)
+            newline = False
+            continue
+        if newline:
+            out.append('\n' + indent * (level + (clause == 'select')) + token)
+        else:
+            out.append((' ' if len(space) > 0 and len(out) > 0 else '') + token)
+        newline = token.startswith('--') or (token == ',' and query_level and clause == 'select')
+        if token in '([':
+            brackets.append(token == '(' and i + 1 < len(tokens) and tokens[i + 1][1].lower() in ('select', 'with'))
+            newline = brackets[-1]
+    return ''.join(out)
+
+
+# Markers of each source language, as regex alternatives (one point per match)
+_dialect_markers = {
+    'hive': [r'`', r'\blateral\s+view\b', r'\bnamed_struct\s*\(', r'\bcollect_(?:set|list)\s*\(', r'\bpmod\s*\(',
+             r'\bexplode\s*\(', r'\bget_json_object\s*\(', r'\bpercentile_approx\s*\(', r'\binsert\s+overwrite\b',
+             r'\bmap_from_arrays\s*\('],
+    'presto': [r'\bcross\s+join\s+unnest\b', r'\bcardinality\s*\(', r'\barray\s*\[', r'\bapprox_(?:distinct|percentile)\s*\(',
+               r'\bdate_diff\s*\(', r'\belement_at\s*\(', r'\btry_cast\s*\(', r'\bmap_agg\s*\('],
+    'vertica': [r'::', r'\bilike\b', r'\bzeroifnull\s*\(', r'\blistagg\s*\(', r'\bapproximate_\w+\s*\(',
+                r'\bmapaggregate\s*\(', r'\btimestamp(?:add|diff)\s*\(', r'\busing\s+parameters\b'],
+}
+# Literals and comments are matched first, so that the markers they contain are skipped
+_dialect_scanner = re.compile('|'.join([r"'(?:[^'\\]|\\.)*'", r'"[^"]*"', r'--[^\n]*', r'/\*[\s\S]*?\*/']
+                                       + [f'(?P<{d}>' + '|'.join(m) + ')' for d, m in _dialect_markers.items()]), re.I)
+
+
+def detect_dialect(q, default='presto'):
+    """
+    Detect the source language of a query from its markers, in one pass.
+    Returns the language and a confidence score, i.e. its share of the markers found
+    (default and 0 if there isn't any).
+    """
+    
+    scores = dict.fromkeys(_dialect_markers, 0)
+    for m in _dialect_scanner.finditer(q):
+        if m.lastgroup is not None:
+            scores[m.lastgroup] += 1
+    total = sum(scores.values())
+    if total == 0:
+        return default, 0.0
+    dialect = max(scores, key=scores.get)
+    return dialect, scores[dialect] / total
+
+
+def detect_dialects(queries, default='presto'):
+    """
+    Detect the source language of each query, e.g. to route a whole corpus.
+    Returns a list of (language, confidence).
+    """
+    
+    return [detect_dialect(q, default) for q in queries]
+
+
+def load_partition_columns(path):
+    """
+    Load the partition columns from a local JSON config or catalog file, either
+    a list of column names, a {column: type} mapping, or a {table: {column: type}}
+    (or {table: [columns]}) mapping. Returns {column: type or None}.
+    """
+    
+    with open(path) as f:
+        config = json.load(f)
+    return _partition_columns(config)
+
+
+# Partition columns loaded from a file, by path, with the file modification time
+_partition_files = {}
+
+
+def _partition_columns(partition_columns):
+    """
+    Normalize the partition columns given to translate_sql to {column: type or None}.
+    """
+    
+    if partition_columns is None:
+        return None
+    if isinstance(partition_columns, (str, os.PathLike)):
+        mtime = os.stat(partition_columns).st_mtime_ns
+        if _partition_files.get(partition_columns, (None,))[0] != mtime:
+            _partition_files[partition_columns] = (mtime, load_partition_columns(partition_columns))
+        return _partition_files[partition_columns][1]
+    if not isinstance(partition_columns, dict):
+        return {c.lower(): None for c in partition_columns}
+    columns = {}
+    for k, v in partition_columns.items():
+        if isinstance(v, (dict, list, tuple)):
+            columns.update(_partition_columns(v))
+        else:
+            columns[k.lower()] = v.lower() if isinstance(v, str) else None
+    return columns
+
+
+def _partition_column(expr, partition_columns):
+    """
+    Name of the partition column if expr is one (possibly qualified or quoted), else None.
+    """
+    
+    if not partition_columns:
+        return None
+    m = re.fullmatch(r'\s*(?:\w+\.)?["`]?(\w+)["`]?\s*', expr)
+    if m is not None and m.group(1) in partition_columns:
+        return m.group(1)
+    return None
+
+
+def _date(expr, partition_columns, warnings, catalog=None):
+    """
+    Cast an expression as date with date(), if it isn't already done or if it isn't
+    a date column. Partition columns of date type aren't wrapped, as it would prevent
+    partition pruning. Other partition columns, including the ones of unknown type,
+    are cast with a warning.
+    """
+    
+    expr = expr.strip(' ')
+    if 'date(' in expr or _column_kind(expr, catalog) == 'date':
+        return expr
+    column = _partition_column(expr, partition_columns)
+    if column is not None:
+        if partition_columns[column] == 'date':
+            return expr
+        if partition_columns[column] is None:
+            warnings.append(f'Warning: Partition column {column} is cast as date, which prevents partition pruning (give its type if it is a date).')
+        else:
+            warnings.append(f'Warning: Partition column {column} ({partition_columns[column]}) has to be cast as date, which prevents partition pruning.')
+    return 'date(' + expr + ')'
+
+
+def _date_literal(before, expr, partition_columns, warnings):
+    """
+    Cast the literal side of a comparison as date, or as the type of the partition
+    column on the other side of the comparison, so that the column isn't cast.
+    """
+    
+    # only look at column references, i.e. not inside literals or interval units
+    references = re.sub(r"'(?:[^'\\]|\\.)*'|\binterval\s+(?:'[^']*'|[\w.]+)\s+\w+", '', expr)
+    for column in partition_columns or {}:
+        if re.search(r'\b' + column + r'\b', references):
+            warnings.append(f'Warning: Partition column {column} ends up inside a date() cast, which prevents partition pruning.')
+    column = re.findall(r'([\w."`]+)\s*$', before)
+    column = _partition_column(column[0], partition_columns) if len(column) > 0 else None
+    if column is not None and partition_columns[column] not in (None, 'date'):
+        return f'cast(date({expr}) as {partition_columns[column]})'
+    return f'date({expr})'
+
+
+class SchemaCatalog:
+    """
+    Column types, loaded from a local snapshot of the schema: either a JSON file
+    {table: {column: type}}, or a Parquet file with table, column and type columns.
+    Types are indexed by column name for O(1) lookups (a column name with different
+    types in different tables is unknown, unless qualified with the table name),
+    and the snapshot is reloaded when it changes (checked once per query).
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.version = None
+        self.tables = {}
+        self.columns = {}
+        self.refresh()
+    
+    def refresh(self):
+        """
+        Reload the snapshot if the file changed since it was loaded.
+        """
+        
+        stat = os.stat(self.path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version == self.version:
+            return
+        if str(self.path).endswith('.parquet'):
+            import pyarrow.parquet as pq
+            tables = {}
+            for row in pq.read_table(self.path, columns=['table', 'column', 'type']).to_pylist():
+                tables.setdefault(row['table'], {})[row['column']] = row['type']
+        else:
+            with open(self.path) as f:
+                tables = json.load(f)
+        self.tables = {t.lower(): {c.lower(): ty.lower().replace(' ', '') for c, ty in cols.items()} for t, cols in tables.items()}
+        self.columns = {}
+        for cols in self.tables.values():
+            for c, ty in cols.items():
+                self.columns[c] = ty if self.columns.get(c, ty) == ty else None
+        self.version = version
+    
+    def column_type(self, expr):
+        """
+        Type of a column, possibly qualified or quoted, or None if unknown.
+        """
+        
+        m = re.fullmatch(r'\s*(?:(\w+)\.)?["`]?(\w+)["`]?\s*', expr)
+        if m is None:
+            return None
+        if m.group(1) in self.tables:
+            return self.tables[m.group(1)].get(m.group(2))
+        return self.columns.get(m.group(2))
+
+
+# Schema catalogs given by path, so that they are only loaded once
+_schema_catalogs = {}
+
+
+def _schema_catalog(catalog):
+    """
+    Get the schema catalog given to translate_sql, up to date.
+    """
+    
+    if catalog is None:
+        return None
+    if not isinstance(catalog, SchemaCatalog):
+        if catalog not in _schema_catalogs:
+            _schema_catalogs[catalog] = SchemaCatalog(catalog)
+        catalog = _schema_catalogs[catalog]
+    catalog.refresh()
+    return catalog
+
+
+def _column_kind(expr, catalog):
+    """
+    Kind of type of a column according to the schema catalog: 'integer', 'float',
+    'string', 'date', 'timestamp', 'map', 'array', 'array of struct', 'struct',
+    or None if unknown.
+    """
+    
+    if catalog is None:
+        return None
+    t = catalog.column_type(expr)
+    if t is None:
+        return None
+    if t.startswith('array<struct') or t.startswith('array(row'):
+        return 'array of struct'
+    for prefix, kind in (('map', 'map'), ('array', 'array'), ('struct', 'struct'), ('row', 'struct'),
+                         ('decimal', 'float'), ('varchar', 'string'), ('char', 'string')):
+        if t.startswith(prefix):
+            return kind
+    kinds = {'float': 'float', 'double': 'float', 'real': 'float', 'string': 'string',
+             'int': 'integer', 'integer': 'integer', 'bigint': 'integer', 'smallint': 'integer', 'tinyint': 'integer',
+             'date': 'date', 'timestamp': 'timestamp'}
+    return kinds.get(t)
+
+
+def _varchar_length(t):
+    """
+    Length of a varchar(n) or char(n) type, or None if there isn't any.
+    """
+    
+    m = re.fullmatch(r'\s*(?:var)?char\s*\(\s*(\d+)\s*\)\s*', t or '')
+    return int(m.group(1)) if m is not None else None
+
+
+def _cast_division(q, catalog):
+    """
+    Cast divisions as float (*1.0000), skipping the / in literals and comments, and
+    the divisions with a floating-point member. Returns the query and the count.
+    """
+    
+    counter = 0
+    def cast(m):
+        nonlocal counter
+        # literal or comment
+        if m.group(1) is not None:
+            return m.group(0)
+        for member in (m.group(2), m.group(4)):
+            if member is not None and (re.fullmatch(r'\d*\.\d+(e[+-]?\d+)?|\d+\.\d*(e[+-]?\d+)?|\d+e[+-]?\d+', member) \
+               or _column_kind(member, catalog) == 'float'):
+                return m.group(0)
+        counter += 1
+        return (m.group(2) or '') + m.group(3) + '*1.0000 /'
+    r = r'''('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`|/\*[\s\S]*?\*/)|([\w.]+)?(\s*)/(?!\*)(?=\s*([\w.]+)?)'''
+    q = re.sub(r, cast, q)
+    return q, counter
+
+
+# Performance hints, for each dest language: (name, pattern, replacement), with
+# patterns in the regex module syntax (run on the lowercase translated query)
+# - a plain regex prefix has no special character, so that it can be a like pattern
+_plain_prefix = r"'\^([^'\\.^$*+?()\[\]{}|%_]*)'"
+_optimize_skip = r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`|--[^\n]*|/\*[\s\S]*?\*/"""
+_optimizations = {
+    'presto': [
+        ['count(distinct) -> approx_distinct()', r'\bcount\s*\(\s*distinct\s+([^(),]+?)\s*\)', r'approx_distinct(\1)'],
+        ['array_distinct(array_agg() over window) -> set_agg() over window',
+         r'\barray_distinct\s*\(\s*array_agg\s*(\((?>[^()]++|(?1))*\))(\s*over\s*(\((?>[^()]++|(?3))*\)))\s*\)', r'set_agg\1\2'],
+        ["regexp_like(x, '^prefix') -> x like 'prefix%'", r'\bregexp_like\s*\(\s*([\w."]+)\s*,\s*' + _plain_prefix + r'\s*\)', r"\1 like '\2%'"],
+    ],
+    'hive': [
+        ["x rlike '^prefix' -> x like 'prefix%'", r'([\w.`]+)\s+rlike\s+' + _plain_prefix, r"\1 like '\2%'"],
+        ['percentile_approx(x, p) -> percentile_approx(x, p, 1000), with lower accuracy',
+         r'\b(percentile_approx\s*\(\s*[^(),]+,\s*[\d.]+)\s*\)', r'\1, 1000)'],
+    ],
+    'vertica': [
+        ['count(distinct) -> approximate_count_distinct()', r'\bcount\s*\(\s*distinct\s+([^(),]+?)\s*\)', r'approximate_count_distinct(\1)'],
+        ["regexp_like(x, '^prefix') -> x like 'prefix%'", r'\bregexp_like\s*\(\s*([\w."]+)\s*,\s*' + _plain_prefix + r'\s*\)', r"\1 like '\2%'"],
+    ],
+}
+
+
+def _optimize(q, dest, mode, replacements, warnings):
+    """
+    Performance hints for the dest language: with mode='apply', rewrite the query with
+    the cheaper equivalents, each one reported in the replacements; with mode='propose',
+    only report them as warnings (hints) for the user to review.
+    """
+    
+    if mode not in ('propose', 'apply'):
+        raise ValueError("optimize must be 'propose' or 'apply'.")
+    for name, r, replacement in _optimizations.get(dest, []):
+        # literals, quoted identifiers and comments are skipped (unless the pattern matches
+        # right at their start, e.g. a quoted column)
+        r = '(?:' + r + ')|(?:' + _optimize_skip + ')(*SKIP)(*FAIL)'
+        if mode == 'apply':
+            q, count = regex.subn(r, replacement, q)
+            replacements.append(['optimize: ' + name, count])
+        else:
+            count = len(regex.findall(r, q))
+            if count > 0:
+                warnings.append(f'Hint: cheaper equivalent, {name} ({count} occurrence(s)), use optimize="apply" to rewrite.')
+    return q
+
+
+# Tokens which matter for the brackets: literals and quoted identifiers (skipped as
+# a whole), brackets and commas
+_bracket_tokens = re.compile(r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`|[()\[\],]""")
+
+
+class BracketIndex:
+    """
+    Index of the brackets of a query, computed in one pass, skipping string literals
+    and quoted identifiers: for each opening bracket, the position of its matching
+    closing bracket (close) and of its top-level commas (commas). When a balanced
+    part of the query is replaced, the index is updated by only scanning the new
+    text and shifting the positions after it: the update is linear in the number
+    of brackets, commas and literals, but doesn't run the regex on the whole query.
+    """
+    
+    def __init__(self, q):
+        self.q = q
+        self.close = {}
+        self.commas = {}
+        self.literals = []
+        self._scan(q, 0, None)
+    
+    def _scan(self, text, offset, parent):
+        # the top-level commas of text belong to the parent opening bracket, if any
+        stack = []
+        for m in _bracket_tokens.finditer(text):
+            token = m.group()
+            pos = offset + m.start()
+            if token in '([':
+                stack.append(pos)
+                self.commas[pos] = []
+            elif token in ')]':
+                if len(stack) > 0:
+                    self.close[stack.pop()] = pos
+            elif token == ',':
+                if len(stack) > 0:
+                    self.commas[stack[-1]].append(pos)
+                elif parent is not None:
+                    self.commas[parent].append(pos)
+            else:
+                self.literals.append((pos, offset + m.end()))
+    
+    def in_literal(self, pos):
+        i = bisect.bisect_right(self.literals, (pos, float('inf'))) - 1
+        return i >= 0 and self.literals[i][0] <= pos < self.literals[i][1]
+    
+    def args(self, open_):
+        """
+        Top-level arguments (raw text) of the brackets opening at open_.
+        """
+        
+        bounds = [open_] + self.commas[open_] + [self.close[open_]]
+        return [self.q[a + 1:b] for a, b in zip(bounds, bounds[1:])]
+    
+    def replace(self, start, end, text):
+        """
+        Replace q[start:end], which must be balanced, with text (balanced too).
+        """
+        
+        delta = len(text) - (end - start)
+        shift = lambda pos: pos + delta if pos >= end else pos
+        inside = lambda pos: start <= pos < end
+        # innermost bracket around the replaced part
+        parent = max([o for o, c in self.close.items() if o < start and c >= end], default=None)
+        self.close = {shift(o): shift(c) for o, c in self.close.items() if not inside(o)}
+        self.commas = {shift(o): [shift(p) for p in commas if not inside(p)] for o, commas in self.commas.items() if not inside(o)}
+        self.literals = [(shift(a), shift(b)) for a, b in self.literals if not inside(a)]
+        self.q = self.q[:start] + text + self.q[end:]
+        self._scan(text, start, parent)
+        # the commas of the new text may come before other commas of the parent bracket
+        if parent is not None:
+            self.commas[parent].sort()
+        self.literals.sort()
+
+
+# Last bracket index computed, reused as long as the query doesn't change in between
+_bracket_indexes = threading.local()
+
+
+def _bracket_index(q):
+    index = getattr(_bracket_indexes, 'index', None)
+    if index is None or index.q != q:
+        index = _bracket_indexes.index = BracketIndex(q)
+    return index
+
+
+def _rewrite_calls(q, names, rewrite):
+    """
+    Rewrite the calls of some functions with the bracket index: rewrite(name, args)
+    gets the function name and its top-level arguments (raw text), and returns the
+    new call, or None to keep it. Inner calls are rewritten before outer ones.
+    Returns the query and the number of calls rewritten.
+    """
+    
+    index = _bracket_index(q)
+    calls = [m for m in re.finditer(r'\b(' + '|'.join(names) + r')\s*\(', q) if not index.in_literal(m.start())]
+    counter = 0
+    for m in calls[::-1]:
+        open_ = m.end() - 1
+        if open_ not in index.close:
+            continue
+        end = index.close[open_] + 1
+        new = rewrite(m.group(1), index.args(open_))
+        if new is None:
+            continue
+        # keep the number of newlines, which are used to put the comments back
+        new += '\n' * (index.q.count('\n', m.start(), end) - new.count('\n'))
+        index.replace(m.start(), end, new)
+        counter += 1
+    return index.q, counter
+
+
+def _split_args(text):
+    """
+    Split text on its top-level commas, i.e. not inside brackets or literals.
+    """
+    
+    parts = []
+    depth = start = 0
+    for m in _bracket_tokens.finditer(text):
+        token = m.group()
+        if token in '([':
+            depth += 1
+        elif token in ')]':
+            depth = max(depth - 1, 0)
+        elif token == ',' and depth == 0:
+            parts.append(text[start:m.start()])
+            start = m.end()
+    return parts + [text[start:]]
+
+
+def _unwrap_call(text, names):
+    """
+    Arguments (raw text) of a call to one of the functions, if text is exactly such a call.
+    """
+    
+    m = re.match(r'\s*(' + '|'.join(names) + r')\s*\(', text)
+    if m is None:
+        return None
+    index = BracketIndex(text)
+    close = index.close.get(m.end() - 1)
+    if close is None or text[close + 1:].strip() != '':
+        return None
+    return text[m.end():close]
+
+
+# Registered rules, and their compiled pipeline for each (src, dest)
+_rules = []
+_compiled_rules = {}
+# Points where registered rules can run, relative to the built-in rule stages:
+# common source rules, source & dest specific rules, common dest rules, formatting
+_stages = ('source', 'pair', 'destination', 'format')
+
+
+def register_rule(name, pattern=None, replacement=None, function=None, src=None, dest=None,
+                  before=None, after=None, priority=0, triggers=()):
+    """
+    Register an additional translation rule, run by translate_sql inside its
+    built-in pipeline.
+    - either pattern (regex, with the regex module syntax) and replacement (string
+      or function of the match), or function, which takes the query and returns the
+      new query, or (new query, number of replacements). The query is lowercase,
+      except after='format', where keywords and functions are in capital letters
+    - src, dest: dialect pair where the rule applies (None for any)
+    - before / after: built-in stage the rule is attached to, among 'source',
+      'pair' (src & dest specific rules), 'destination' and 'format'
+      (default: after='destination', i.e. just before formatting)
+    - priority: rules attached to the same point run by decreasing priority
+    - triggers: tokens (words) which must appear in the query for the rule to run,
+      matched regardless of case
+    The rule hits are counted in the replacements report, under name.
+    Registered rules are module state: worker processes started with 'spawn' (the
+    default on macOS and Windows) don't inherit them, so the batch functions using
+    a process pool (translate_sql_column, translate_file, ...) only run them with
+    the 'fork' start method, or with n_jobs=1.
+    """
+    
+    if (pattern is None) == (function is None):
+        raise ValueError('A rule needs either a pattern or a function.')
+    if before is not None and after is not None:
+        raise ValueError('A rule can only be attached before or after one stage.')
+    stage = before or after or 'destination'
+    if stage not in _stages:
+        raise ValueError(f"Unknown stage '{stage}', must be one of {', '.join(_stages)}.")
+    if pattern is not None:
+        pattern = regex.compile(pattern)
+        replacement = replacement if replacement is not None else ''
+    rule = {'name': name, 'pattern': pattern, 'replacement': replacement, 'function': function,
+            'src': src, 'dest': dest, 'point': _stages.index(stage) + (before is None),
+            'priority': priority, 'triggers': frozenset(t.lower() for t in triggers)}
+    unregister_rule(name)
+    _rules.append(rule)
+    _compiled_rules.clear()
+    return rule
+
+
+def unregister_rule(name):
+    """
+    Remove a registered rule (no error if it doesn't exist).
+    """
+    
+    _rules[:] = [r for r in _rules if r['name'] != name]
+    _compiled_rules.clear()
+
+
+def _compile_rules(src, dest):
+    """
+    Select the registered rules for a dialect pair and order them for each point
+    of the built-in pipeline, with a single regex per point matching all the
+    trigger tokens. Cached until rules are registered or removed.
+    """
+    
+    compiled = None
+    selected = [r for r in _rules if r['src'] in (None, src) and r['dest'] in (None, dest)]
+    if len(selected) > 0:
+        compiled = []
+        for point in range(len(_stages) + 1):
+            rules = sorted([r for r in selected if r['point'] == point], key=lambda r: -r['priority'])
+            tokens = sorted(set().union(*[r['triggers'] for r in rules]), key=len, reverse=True)
+            triggers = re.compile(r'\b(' + '|'.join(re.escape(t) for t in tokens) + r')\b', re.I) if tokens else None
+            compiled.append((rules, triggers))
+    _compiled_rules[(src, dest)] = compiled
+    return compiled
+
+
+def _apply_rules(q, rules, point, replacements):
+    """
+    Run the registered rules attached to one point of the built-in pipeline.
+    """
+    
+    if rules is None or len(rules[point][0]) == 0:
+        return q
+    rules, triggers = rules[point]
+    found = set(t.lower() for t in triggers.findall(q)) if triggers is not None else set()
+    for rule in rules:
+        if rule['triggers'] and rule['triggers'].isdisjoint(found):
+            replacements.append([rule['name'], 0])
+            continue
+        if rule['pattern'] is not None:
+            q, count = rule['pattern'].subn(rule['replacement'], q)
+        else:
+            result = rule['function'](q)
+            q, count = result if isinstance(result, tuple) else (result, int(result != q))
+        replacements.append([rule['name'], count])
+        # the query changed, so the tokens may have changed too
+        if count > 0 and triggers is not None:
+            found = set(t.lower() for t in triggers.findall(q))
+    return q
+
+
+class _TimedReplacements(list):
+    """
+    List of replacements which also records the time spent on each rule, i.e.
+    the time elapsed since the previous rule appended its counter (rules append it
+    once their substitution is done). The time spent outside of the rules (comments,
+    formatting) is recorded with stamp().
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self.timings = []
+        self.last = time.perf_counter()
+    
+    def append(self, replacement):
+        now = time.perf_counter()
+        self.timings.append((replacement[0], now - self.last))
+        self.last = now
+        super().append(replacement)
+    
+    def stamp(self, label='other'):
+        now = time.perf_counter()
+        self.timings.append((label, now - self.last))
+        self.last = now
+
+
+class TranslationMetrics:
+    """
+    Rule hits, warnings and latency metrics of translate_sql, by (src, dest).
+    - counters: number of replacements made by each rule, number of each warning
+    - histograms: latency of each rule (rule="other" for the time spent outside of
+      the rules, e.g. formatting) and of the whole query
+    Memory and cost per query are bounded by the number of rules: values are
+    aggregated in place, with fixed histogram buckets. Metrics can be exported
+    as a Prometheus textfile, or pushed with flush() to a sink, i.e. any object
+    with a send(name, kind, tags, value) method, such as StatsdSink.
+    """
+    
+    buckets = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+    
+    def __init__(self, sink=None, prefix='translate_sql'):
+        self.sink = sink
+        self.prefix = prefix
+        self.counters = {} # (name, tags) -> value
+        self.histograms = {} # (name, tags) -> [count per bucket..., count for +Inf, sum]
+        self.flushed = {} # (name, tags) -> value already sent to the sink
+        self.lock = threading.Lock()
+    
+    def observe(self, src, dest, replacements, warnings, elapsed):
+        """
+        Record the results of one translation.
+        """
+        
+        with self.lock:
+            for rule, count in replacements:
+                if count != 0:
+                    self._count('rule_hits_total', (('src', src), ('dest', dest), ('rule', rule)), count)
+            for w in set(warnings):
+                self._count('warnings_total', (('src', src), ('dest', dest), ('warning', w)), 1)
+            for rule, seconds in getattr(replacements, 'timings', []):
+                self._time('rule_latency_seconds', (('src', src), ('dest', dest), ('rule', rule)), seconds)
+            self._time('query_latency_seconds', (('src', src), ('dest', dest)), elapsed)
+    
+    def _count(self, name, tags, value):
+        self.counters[(name, tags)] = self.counters.get((name, tags), 0) + value
+    
+    def _time(self, name, tags, seconds):
+        h = self.histograms.get((name, tags))
+        if h is None:
+            h = self.histograms[(name, tags)] = [0] * (len(self.buckets) + 2)
+        for i, b in enumerate(self.buckets):
+            if seconds <= b:
+                h[i] += 1
+                break
+        else:
+            h[len(self.buckets)] += 1
+        h[-1] += seconds
+    
+    def _samples(self):
+        # flatten counters and cumulative histograms into (name, kind, tags, value)
+        samples = [(name, 'counter', tags, value) for (name, tags), value in self.counters.items()]
+        for (name, tags), h in self.histograms.items():
+            cumulated = 0
+            for b, c in zip(self.buckets + ('+Inf',), h[:-1]):
+                cumulated += c
+                samples.append((name + '_bucket', 'histogram', tags + (('le', str(b)),), cumulated))
+            samples.append((name + '_sum', 'histogram', tags, h[-1]))
+            samples.append((name + '_count', 'histogram', tags, cumulated))
+        return samples
+    
+    def to_prometheus(self):
+        """
+        Metrics in the Prometheus text exposition format.
+        """
+        
+        helps = {'rule_hits_total': 'Number of replacements made by each translation rule.',
+                 'warnings_total': 'Number of translations raising each warning.',
+                 'rule_latency_seconds': 'Time spent on each translation rule.',
+                 'query_latency_seconds': 'Time spent on the translation of a whole query.'}
+        with self.lock:
+            samples = self._samples()
+        lines = []
+        for base, text in helps.items():
+            selected = [s for s in samples if re.sub(r'_(bucket|sum|count)$', '', s[0]) == base]
+            if len(selected) == 0:
+                continue
+            lines.append(f'# HELP {self.prefix}_{base} {text}')
+            lines.append(f'# TYPE {self.prefix}_{base} {selected[0][1]}')
+            for name, _, tags, value in selected:
+                labels = ','.join(f'{k}="{_escape_label(v)}"' for k, v in tags)
+                lines.append(f'{self.prefix}_{name}{{{labels}}} {value}')
+        return '\n'.join(lines) + '\n'
+    
+    def write_prometheus_textfile(self, path):
+        """
+        Write the metrics for the node exporter textfile collector (atomically).
+        """
+        
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp, path)
+    
+    def flush(self):
+        """
+        Send what changed since the last flush to the sink, as counter increments.
+        """
+        
+        if self.sink is None:
+            return
+        with self.lock:
+            samples = self._samples()
+        for name, kind, tags, value in samples:
+            delta = value - self.flushed.get((name, tags), 0)
+            if delta != 0:
+                self.sink.send(f'{self.prefix}_{name}', kind, tags, delta)
+                self.flushed[(name, tags)] = value
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class StatsdSink:
+    """
+    Metrics sink sending StatsD counters over UDP, with DogStatsD-style tags
+    (a local collector only needs to listen on the same host and port).
+    """
+    
+    def __init__(self, host='127.0.0.1', port=8125):
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    
+    def send(self, name, kind, tags, value):
+        # statsd doesn't allow spaces or separators in tag values
+        tags = ','.join(k + ':' + re.sub(r'[^\w.\-]+', '_', str(v)) for k, v in tags)
+        self.socket.sendto(f'{name}:{value}|c|#{tags}'.encode(), self.address)
+
+
+def translate_sql_column(queries, src='presto', dest='hive', n_jobs=None, chunksize=256, **options):
+    """
+    Translate a whole column of queries (list, numpy array, pandas Series or pyarrow
+    string array), with src and dest given as scalars or as columns of the same length,
+    and options passed to translate_sql (e.g. partition_columns).
+    Identical queries are only translated once, and unique queries are processed in
+    parallel chunks. Returns separate columns for the translated sql, the warnings
+    and the counter of each replacement: a pandas DataFrame for a pandas input,
+    a pyarrow Table for a pyarrow input, else a dict of lists.
+    """
+    
+    # Deduplicate the (query, src, dest) triplets: we keep the unique ones and,
+    # for each row, the position of its triplet in the unique list
+    if type(queries).__module__.startswith('pyarrow'):
+        uniques, codes = _factorize_arrow(queries, src, dest)
+    elif type(queries).__module__.startswith('pandas'):
+        uniques, codes = _factorize_pandas(queries, src, dest)
+    else:
+        uniques, codes = _factorize_list(queries, src, dest)
+    
+    # Translate the unique queries, by chunks, in parallel if needed
+    chunks = [uniques[i:i+chunksize] for i in range(0, len(uniques), chunksize)]
+    results = _map_chunks(_translate_chunk, chunks, n_jobs, options)
+    
+    # Build one column per output, at the unique level
+    sql = [r[0] for r in results]
+    warnings = [r[1] for r in results]
+    rules = list(dict.fromkeys(rule for r in results for rule in r[2]))
+    counts = {rule: [r[2].get(rule, 0) for r in results] for rule in rules}
+    
+    # Then expand back to the original rows
+    if type(queries).__module__.startswith('pyarrow'):
+        import pyarrow as pa
+        columns = {'sql': pa.array(sql, pa.string()), 'warnings': pa.array(warnings, pa.list_(pa.string()))}
+        columns.update({rule: pa.array(c, pa.int64()) for rule, c in counts.items()})
+        return pa.table({name: col.take(codes) for name, col in columns.items()})
+    columns = {'sql': sql, 'warnings': warnings}
+    columns.update(counts)
+    columns = {name: [col[i] for i in codes] for name, col in columns.items()}
+    if type(queries).__module__.startswith('pandas'):
+        import pandas as pd
+        return pd.DataFrame(columns, index=queries.index, columns=list(columns))
+    return columns
+
+
+def _map_chunks(function, chunks, n_jobs, *args, executor=None):
+    """
+    Run function(chunk, *args) on each chunk, in a process pool if n_jobs > 1 (None
+    for the number of CPUs), or in the given executor, and return the results of
+    all the chunks, concatenated in order.
+    """
+    
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs == 1 or len(chunks) <= 1:
+        results = [function(c, *args) for c in chunks]
+    elif executor is not None:
+        results = executor.map(function, chunks, *[[a] * len(chunks) for a in args])
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(function, chunks, *[[a] * len(chunks) for a in args]))
+    return [r for chunk in results for r in chunk]
+
+
+def _factorize_list(queries, src, dest):
+    """
+    Deduplicate (query, src, dest) triplets given as python sequences or scalars.
+    """
+    
+    n = len(queries)
+    srcs = [src] * n if isinstance(src, str) else list(src)
+    dests = [dest] * n if isinstance(dest, str) else list(dest)
+    positions = {}
+    codes = []
+    for key in zip(queries, srcs, dests):
+        codes.append(positions.setdefault(key, len(positions)))
+    return list(positions), codes
+
+
+def _factorize_pandas(queries, src, dest):
+    """
+    Deduplicate (query, src, dest) triplets with pandas' hash-based factorize.
+    """
+    
+    import pandas as pd
+    if isinstance(src, str) and isinstance(dest, str):
+        codes, uniques = pd.factorize(queries, use_na_sentinel=False)
+        uniques = [(q if isinstance(q, str) else None, src, dest) for q in uniques]
+    else:
+        n = len(queries)
+        srcs = [src] * n if isinstance(src, str) else list(src)
+        dests = [dest] * n if isinstance(dest, str) else list(dest)
+        codes, uniques = pd.factorize(pd.MultiIndex.from_arrays([list(queries), srcs, dests]))
+        uniques = [(q if isinstance(q, str) else None, s, d) for q, s, d in uniques]
+    return uniques, codes
+
+
+def _factorize_arrow(queries, src, dest):
+    """
+    Deduplicate (query, src, dest) triplets with pyarrow compute kernels, so that
+    only the unique queries are ever converted to python strings.
+    """
+    
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    if isinstance(src, str) and isinstance(dest, str):
+        uniques = pc.unique(queries)
+        codes = pc.index_in(queries, value_set=uniques)
+        uniques = [(q, src, dest) for q in uniques.to_pylist()]
+    else:
+        # join the 3 columns with a separator which can't appear in a query
+        n = len(queries)
+        srcs = pa.array([src] * n) if isinstance(src, str) else src
+        dests = pa.array([dest] * n) if isinstance(dest, str) else dest
+        keys = pc.binary_join_element_wise(srcs, dests, queries, '\x1f', null_handling='replace', null_replacement='\x00')
+        uniques = pc.unique(keys)
+        codes = pc.index_in(keys, value_set=uniques)
+        uniques = [u.split('\x1f', 2) for u in uniques.to_pylist()]
+        uniques = [(q if q != '\x00' else None, s, d) for s, d, q in uniques]
+    return uniques, codes
+
+
+def _translate_chunk(chunk, options=None):
+    """
+    Translate a chunk of (query, src, dest) triplets, i.e. the unit of work sent to
+    worker processes. Returns (sql, warnings, replacements counters) for each query.
+    """
+    
+    results = []
+    for q, src, dest in chunk:
+        if q is None:
+            results.append((None, [], {}))
+            continue
+        q, replacements, warnings, session_parameters = _translate_sql(q, src, dest, **(options or {}))
+        counts = {}
+        for r in replacements:
+            if r[1] != 0:
+                counts[r[0]] = counts.get(r[0], 0) + r[1]
+        results.append((session_parameters.lstrip('\n') + q, list(dict.fromkeys(warnings)), counts))
+    return results
+
+
+def translate_query_log(source, output, src='presto', dests=('hive', 'vertica'), query_field='query',
+                        n_jobs=None, max_pending=1024, dedup_window=10000, ordered=True,
+                        use_mmap=False, report=None, report_every=10, **options):
+    """
+    Translate a JSON-lines query log (e.g. Presto query completion events) into
+    each of the dest languages, as a streaming pipeline stage.
+    - source: path of the log, or file object (e.g. sys.stdin for a pipe),
+      read with mmap if use_mmap=True and source is a path
+    - output: path or file object, where each record is written back as JSON
+      with an additional 'translations' field {dest: {'sql', 'warnings'}}
+    - queries are deduplicated by hash within a sliding window of dedup_window
+      distinct queries, and translated by a pool of n_jobs worker processes
+    - at most max_pending records are waiting to be written (backpressure:
+      reading stops when the queue is full), in input order if ordered=True
+    - report(stats) is called every report_every seconds if given
+    - other options are passed to translate_sql (e.g. partition_columns)
+    Returns the pipeline statistics (throughput, queue depth, latency per stage).
+    """
+    
+    stats = {'read': 0, 'invalid': 0, 'translated': 0, 'duplicates': 0, 'errors': 0, 'written': 0,
+             'queue_depth': 0, 'max_queue_depth': 0, 'elapsed': 0.0, 'throughput': 0.0,
+             'latency': {stage: {'total': 0.0, 'max': 0.0} for stage in ('read', 'translate', 'write', 'end_to_end')}}
+    def observe(stage, seconds):
+        stats['latency'][stage]['total'] += seconds
+        stats['latency'][stage]['max'] = max(stats['latency'][stage]['max'], seconds)
+    
+    start = last_report = time.perf_counter()
+    window = OrderedDict() # query hash -> future, for the deduplication
+    pending = deque() # (record, future, read time, whether it was sent to the pool), in input order
+    waiting = {} # future -> [(record, read time, whether it was sent to the pool)], used when output can be unordered
+    
+    def emit(record, future, t_read, submitted, out):
+        t = time.perf_counter()
+        translations, elapsed, error = future.result()
+        # the translation latency is counted once per query sent to the pool, not for duplicates
+        if submitted:
+            observe('translate', elapsed)
+        if error is not None:
+            record['translation_error'] = error
+            stats['errors'] += 1
+        else:
+            record['translations'] = translations
+        out.write(json.dumps(record) + '\n')
+        stats['written'] += 1
+        observe('write', time.perf_counter() - t)
+        observe('end_to_end', time.perf_counter() - t_read)
+    
+    def drain(out, block):
+        # write the finished records, and wait for some if the queue is full
+        if ordered:
+            while pending and (pending[0][1].done() or (block and len(pending) >= max_pending)):
+                emit(*pending.popleft(), out)
+        else:
+            if block and sum(len(v) for v in waiting.values()) >= max_pending:
+                wait(waiting, return_when=FIRST_COMPLETED)
+            for future in [f for f in waiting if f.done()]:
+                for record, t_read, submitted in waiting.pop(future):
+                    emit(record, future, t_read, submitted, out)
+        stats['queue_depth'] = len(pending) if ordered else sum(len(v) for v in waiting.values())
+    
+    with _open_query_log(source, use_mmap) as lines, _open_output(output) as out, \
+         ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        for line in lines:
+            t_read = time.perf_counter()
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                q = record[query_field]
+            except (ValueError, KeyError, TypeError):
+                stats['invalid'] += 1
+                continue
+            if not isinstance(q, str):
+                stats['invalid'] += 1
+                continue
+            stats['read'] += 1
+            observe('read', time.perf_counter() - t_read)
+            
+            # deduplicate within the sliding window, else send to the worker pool
+            key = hashlib.blake2b(q.encode('utf-8', 'replace'), digest_size=16).digest()
+            future = window.get(key)
+            submitted = future is None
+            if not submitted:
+                window.move_to_end(key)
+                stats['duplicates'] += 1
+            else:
+                future = executor.submit(_translate_log_query, q, src, dests, options)
+                window[key] = future
+                if len(window) > dedup_window:
+                    window.popitem(last=False)
+                stats['translated'] += 1
+            if ordered:
+                pending.append((record, future, t_read, submitted))
+            else:
+                waiting.setdefault(future, []).append((record, t_read, submitted))
+            stats['max_queue_depth'] = max(stats['max_queue_depth'], stats['queue_depth'] + 1)
+            
+            drain(out, block=True)
+            if report is not None and time.perf_counter() - last_report >= report_every:
+                last_report = time.perf_counter()
+                report(_query_log_stats(stats, start))
+        
+        # flush what is left
+        while pending or waiting:
+            if waiting:
+                wait(waiting)
+            elif pending:
+                pending[0][1].result()
+            drain(out, block=False)
+    
+    stats = _query_log_stats(stats, start)
+    if report is not None:
+        report(stats)
+    return stats
+
+
+def _query_log_stats(stats, start):
+    """
+    Snapshot of the pipeline statistics, with throughput and mean latencies.
+    """
+    
+    stats = copy.deepcopy(stats)
+    stats['elapsed'] = time.perf_counter() - start
+    stats['throughput'] = stats['written'] / stats['elapsed'] if stats['elapsed'] > 0 else 0.0
+    counts = {'read': stats['read'], 'translate': stats['translated'], 'write': stats['written'], 'end_to_end': stats['written']}
+    for stage, latency in stats['latency'].items():
+        latency['mean'] = latency['total'] / counts[stage] if counts[stage] > 0 else 0.0
+    return stats
+
+
+def _translate_log_query(q, src, dests, options=None):
+    """
+    Translate one logged query into each dest language (run in worker processes).
+    Returns the translations, the time spent and the error if any.
+    """
+    
+    t = time.perf_counter()
+    try:
+        translations = {}
+        for dest in dests:
+            sql, warnings, _ = _translate_chunk([(q, src, dest)], options)[0]
+            translations[dest] = {'sql': sql, 'warnings': warnings}
+        return translations, time.perf_counter() - t, None
+    except Exception as e:
+        return None, time.perf_counter() - t, repr(e)
+
+
+@contextmanager
+def _open_query_log(source, use_mmap=False):
+    """
+    Iterate over the lines of a query log given as a path (optionally memory-mapped)
+    or as an already opened file object, such as a pipe.
+    """
+    
+    if not isinstance(source, (str, os.PathLike)):
+        yield iter(source)
+        return
+    with open(source, 'rb') as f:
+        if not use_mmap or os.fstat(f.fileno()).st_size == 0:
+            yield iter(f)
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield iter(mm.readline, b'')
+
+
+@contextmanager
+def _open_output(output):
+    """
+    Write to a path (with a large buffer) or to an already opened file object.
+    """
+    
+    if not isinstance(output, (str, os.PathLike)):
+        yield output
+        return
+    with open(output, 'w', buffering=1 << 20) as f:
+        yield f
+
+
+def translate_file(input_path, output_path, src='presto', dest='hive', n_jobs=1, batch_size=64, **options):
+    """
+    Translate a file of SQL statements separated by ';' (e.g. a schema or ETL dump),
+    one statement at a time: the input is memory-mapped and scanned for statement
+    boundaries, and translations go through a buffered writer, so that memory is
+    bounded by the largest statement (times batch_size) rather than the file size.
+    With n_jobs > 1 (None for the number of CPUs), each batch of statements is
+    translated by a process pool.
+    Other options are passed to translate_sql (e.g. partition_columns).
+    Returns the total replacements counters and the warnings.
+    """
+    
+    totals = {}
+    warnings = {} # deduplicated as they come, used as an ordered set
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    def write_batch(batch, out):
+        # only statements with some SQL in them are translated
+        todo = [(body, src, dest) for body, _ in batch if _has_sql(body)]
+        size = max(-(-len(todo) // n_jobs), 1)
+        chunks = [todo[i:i+size] for i in range(0, len(todo), size)]
+        results = iter(_map_chunks(_translate_chunk, chunks, n_jobs, options, executor=executor))
+        for body, end in batch:
+            if _has_sql(body):
+                sql, w, counts = next(results)
+                warnings.update(dict.fromkeys(w))
+                for rule, count in counts.items():
+                    totals[rule] = totals.get(rule, 0) + count
+                # the session parameters go on their own line, after the previous statement
+                if sql.startswith('SET ') and out.tell() > 0:
+                    sql = '\n' + sql
+                out.write(sql + end)
+            else:
+                out.write(body + end)
+    
+    executor = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs != 1 else None
+    try:
+        with open(input_path, 'rb') as f, open(output_path, 'w', buffering=1 << 20, encoding='utf-8') as out:
+            if os.fstat(f.fileno()).st_size == 0:
+                return totals, list(warnings)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                batch = []
+                for start, end in _statement_spans(mm):
+                    statement = mm[start:end].decode('utf-8')
+                    # keep the ';' apart, so that it isn't sent to the translation
+                    if statement.endswith(';'):
+                        batch.append((statement[:-1], ';'))
+                    else:
+                        batch.append((statement, ''))
+                    if len(batch) >= batch_size:
+                        write_batch(batch, out)
+                        batch = []
+                write_batch(batch, out)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return totals, list(warnings)
+
+
+# Session parameter added by the Hive translation when it can't replace column
+# positions in group by / order by, emitted once per script by translate_script
+_position_alias = 'SET hive.groupby.orderby.position.alias=true;\n'
+
+
+def translate_script(script, src='presto', dest='hive', n_jobs=None, chunksize=64, **options):
+    """
+    Translate a script of SQL statements separated by ';' (e.g. a nightly ETL job):
+    the statements are translated in parallel chunks by a process pool, and put back
+    in their original order. The comments between statements and the SET statements
+    are kept as they are, and the Hive session parameter for column positions is
+    emitted once at the top of the script instead of before each statement.
+    Other options are passed to translate_sql (e.g. partition_columns).
+    Returns the translated script, the total replacements counters and the warnings.
+    """
+    
+    # Split each statement into its leading comments and whitespace, its body and its end
+    parts = []
+    for start, end in _statement_spans(script):
+        statement = script[start:end]
+        m = re.match(r'(?:\s+|--[^\n]*|/\*[\s\S]*?\*/)*', statement)
+        body = statement[m.end():]
+        body_end = len(body.rstrip(';').rstrip())
+        parts.append((statement[:m.end()], body[:body_end], body[body_end:]))
+    
+    # Only statements with some SQL in them, other than session parameters, are translated
+    todo = [i for i, (_, body, _) in enumerate(parts) if body != '' and not re.match(r'set\b', body, re.I)]
+    chunks = [todo[i:i+chunksize] for i in range(0, len(todo), chunksize)]
+    chunks = [[(parts[i][1], src, dest) for i in chunk] for chunk in chunks]
+    results = _map_chunks(_translate_chunk, chunks, n_jobs, options)
+    
+    # Reassemble the script in order, merging the session parameters
+    totals = {}
+    warnings = []
+    position_alias = False
+    translated = {}
+    for i, (sql, w, counts) in zip(todo, results):
+        if sql.startswith(_position_alias):
+            sql = sql[len(_position_alias):]
+            position_alias = True
+        translated[i] = sql
+        warnings.extend(w)
+        for rule, count in counts.items():
+            totals[rule] = totals.get(rule, 0) + count
+    script = ''.join(before + translated.get(i, body) + end for i, (before, body, end) in enumerate(parts))
+    # the parameter isn't added if the script sets it itself, to any value
+    values = [m.group(1) for i, (_, body, _) in enumerate(parts) if i not in translated
+              for m in [re.match(r'set\s+hive\.groupby\.orderby\.position\.alias\s*=\s*(\S*)', body, re.I)] if m is not None]
+    if position_alias and len(values) == 0:
+        script = _position_alias + script
+    elif position_alias and any(v.lower() != 'true' for v in values):
+        warnings.append('Warning: The script sets hive.groupby.orderby.position.alias to another value than true, '
+                        'which some translated statements need to use column positions in group by / order by.')
+    return script, totals, list(dict.fromkeys(warnings))
+
+
+# Statement scanner: what can contain a ';' which isn't a statement boundary, and
+# how it ends (quotes can be escaped with a backslash, or doubled which amounts to
+# closing and reopening the quote)
+_scanner = {
+    str: (re.compile(r"""'|"|`|--|/\*|;"""),
+          {"'": re.compile(r"(?:[^'\\]|\\.)*'", re.S), '"': re.compile(r'(?:[^"\\]|\\.)*"', re.S),
+           '`': re.compile(r'[^`]*`'), '--': '\n', '/*': '*/'}),
+    bytes: (re.compile(rb"""'|"|`|--|/\*|;"""),
+            {b"'": re.compile(rb"(?:[^'\\]|\\.)*'", re.S), b'"': re.compile(rb'(?:[^"\\]|\\.)*"', re.S),
+             b'`': re.compile(rb'[^`]*`'), b'--': b'\n', b'/*': b'*/'}),
+}
+
+
+def _statement_spans(buf):
+    """
+    Yield the (start, end) positions of the statements of buf (str, bytes or mmap),
+    each statement ending right after its ';' (or at the end of buf), ignoring
+    the ';' inside string literals, quoted identifiers and comments.
+    Works in a streaming way, without copying buf.
+    """
+    
+    delimiters, ends = _scanner[str] if isinstance(buf, str) else _scanner[bytes]
+    semicolon = ';' if isinstance(buf, str) else b';'
+    start = pos = 0
+    while True:
+        m = delimiters.search(buf, pos)
+        if m is None:
+            break
+        token = m.group()
+        if token == semicolon:
+            yield start, m.end()
+            start = pos = m.end()
+            continue
+        end = ends[token]
+        if isinstance(end, re.Pattern):
+            found = end.match(buf, m.end())
+            pos = found.end() if found is not None else len(buf)
+        else:
+            found = buf.find(end, m.end())
+            pos = found + len(end) if found != -1 else len(buf)
+    if start < len(buf):
+        yield start, len(buf)
+
+
+def _has_sql(statement):
+    """
+    Whether a statement has anything else than comments and whitespace.
+    """
+    
+    return re.sub(r'--[^\n]*|/\*[\s\S]*?\*/', '', statement).strip() != ''
+
+
+def validate_translations(cases, src='presto', dest='hive', engines=None, n_jobs=None, chunksize=64, **options):
+    """
+    Differential validation of translations: each source query is run on an embedded
+    engine standing in for src, its translation on an engine standing in for dest, on
+    the fixture tables of the case, and their result sets are compared.
+    - cases: list of dicts with the 'query', its 'tables' ({name: list of row dicts})
+      and optionally an 'id', processed by chunks in a process pool
+    - engines: {language: engine}, where an engine is 'duckdb', 'sqlite' or a function
+      returning a DB-API connection (defined at module level, so that it can be sent
+      to the workers), e.g. a duckdb connection with settings and macros emulating
+      the language. Else one engine (duckdb if installed, else sqlite) runs both
+      queries: it emulates neither language, so differences are only inconclusive,
+      as when the same engine is given for both languages.
+    Returns a report with the status of each case: 'passed', 'mismatch' (different
+    results), 'broken' (only the translation fails), 'error' (the translation itself
+    fails), 'inconclusive' (a mismatch or failure on a shared stand-in engine) or
+    'unsupported' (the source query doesn't run), and for each rule the number of
+    cases it was applied to and the ids of the ones which broke or were inconclusive.
+    """
+    
+    # With a single engine for both languages, results can't be trusted to differ
+    # because of the translation rather than of the engine
+    if isinstance(engines, dict):
+        engines = (engines[src], engines[dest])
+        conclusive = engines[0] != engines[1]
+    else:
+        engine = engines
+        if engine is None:
+            engine = 'duckdb' if importlib.util.find_spec('duckdb') is not None else 'sqlite'
+        engines = (engine, engine)
+        conclusive = False
+    for engine in engines:
+        if not callable(engine) and engine not in ('duckdb', 'sqlite'):
+            raise ValueError("An engine must be 'duckdb', 'sqlite' or a function returning a connection.")
+    cases = [dict(c, id=c.get('id', i)) for i, c in enumerate(cases)]
+    
+    # Run the cases by chunks, in parallel if needed
+    chunks = [cases[i:i+chunksize] for i in range(0, len(cases), chunksize)]
+    results = _map_chunks(_validate_chunk, chunks, n_jobs, src, dest, engines, conclusive, options)
+    
+    # Attribute the failures to the rules which were applied
+    names = [getattr(e, '__name__', e) for e in engines]
+    report = {'engines': {src: names[0], dest: names[1]}, 'cases': len(results), 'status': {}, 'failures': [], 'rules': {}}
+    for r in results:
+        report['status'][r['status']] = report['status'].get(r['status'], 0) + 1
+        failed = r['status'] in ('mismatch', 'broken', 'error')
+        if failed:
+            report['failures'].append(r)
+        for rule in r['rules']:
+            entry = report['rules'].setdefault(rule, {'applied': 0, 'broken': [], 'inconclusive': []})
+            entry['applied'] += 1
+            if failed:
+                entry['broken'].append(r['id'])
+            elif r['status'] == 'inconclusive':
+                entry['inconclusive'].append(r['id'])
+    return report
+
+
+def _validate_chunk(chunk, src, dest, engines, conclusive, options=None):
+    """
+    Validate a chunk of cases, i.e. the unit of work sent to worker processes.
+    """
+    
+    results = []
+    for case in chunk:
+        result = {'id': case['id'], 'status': 'passed', 'error': None, 'rules': {}, 'translation': None}
+        results.append(result)
+        try:
+            q, replacements, warnings, session_parameters = _translate_sql(case['query'], src, dest, **(options or {}))
+        except Exception as e:
+            result.update(status='error', error=f'{type(e).__name__}: {e}')
+            continue
+        # the session parameters are left out, the engines don't know them
+        result['translation'] = q
+        for r in replacements:
+            if r[1] != 0:
+                result['rules'][r[0]] = result['rules'].get(r[0], 0) + r[1]
+        try:
+            expected = _run_fixture_query(case['query'], case.get('tables', {}), engines[0])
+        except Exception as e:
+            result.update(status='unsupported', error=f'{type(e).__name__}: {e}')
+            continue
+        try:
+            actual = _run_fixture_query(q, case.get('tables', {}), engines[1])
+        except Exception as e:
+            result.update(status='broken' if conclusive else 'inconclusive', error=f'{type(e).__name__}: {e}')
+            continue
+        if actual != expected:
+            result.update(status='mismatch' if conclusive else 'inconclusive',
+                          error=f'{len(expected)} rows expected, {len(actual)} rows returned, with different values.')
+    return results
+
+
+# Column types of the fixture tables, from the python type of their values
+_fixture_types = {bool: 'boolean', int: 'bigint', float: 'double', str: 'varchar'}
+
+
+def _run_fixture_query(q, tables, engine):
+    """
+    Run a query on a fresh database of the engine with the fixture tables, and return
+    its result set as a sorted list of rows (floats rounded), so that it can be
+    compared regardless of the row order.
+    """
+    
+    if callable(engine):
+        connection = engine()
+    elif engine == 'duckdb':
+        import duckdb
+        connection = duckdb.connect(':memory:')
+    else:
+        import sqlite3
+        connection = sqlite3.connect(':memory:')
+    try:
+        for name, rows in tables.items():
+            columns = list(dict.fromkeys(c for row in rows for c in row))
+            types = [next((_fixture_types.get(type(row[c]), 'varchar') for row in rows if row.get(c) is not None), 'varchar')
+                     for c in columns]
+            connection.execute(f'create table {name} (' + ', '.join(f'"{c}" {t}' for c, t in zip(columns, types)) + ')')
+            if len(rows) > 0:
+                connection.executemany(f'insert into {name} values (' + ', '.join(['?'] * len(columns)) + ')',
+                                       [tuple(row.get(c) for c in columns) for row in rows])
+        rows = connection.execute(q.strip().rstrip(';')).fetchall()
+    finally:
+        connection.close()
+    rows = [tuple(round(float(v), 6) if isinstance(v, (int, float)) and not isinstance(v, bool) else v for v in row) for row in rows]
+    return sorted(rows, key=repr)
@@ -0,0 +1,276 @@
+import pytest
+
+from criteo_help import translate_sql, translate_query_log, translate_file, translate_script, validate_translations, TranslationMetrics
+
+
+def test_comments_kept_when_rewrites_add_newlines():
+    # nullifzero copies its argument twice, so the translation has more newlines than the query
+    q = translate_sql("select nullifzero(\n a) -- c1\nfrom t -- c2\nwhere x = 1", 'vertica', 'hive', verbose=False)
+    assert '-- c1' in q and '-- c2' in q
+    assert q.rstrip().endswith('WHERE x = 1')
+
+
+def test_auto_source_in_dest_language_is_left_untranslated():
+    q = "select named_struct('k', a) as s, b rlike '^x' from t lateral view explode(arr) e as x"
+    assert translate_sql(q, 'auto', 'hive', verbose=False).strip() == q
+
+
+def test_auto_source_is_recorded_in_metrics():
+    metrics = TranslationMetrics()
+    translate_sql("select a::int from t where b ilike 'x%'", 'auto', 'hive', metrics=metrics)
+    assert 'src="vertica"' in metrics.to_prometheus()
+    assert 'src="auto"' not in metrics.to_prometheus()
+
+
+def test_interval_unit_is_not_a_partition_column():
+    q = translate_sql("select a from t where day = current_date - interval 1 day", 'hive', 'presto',
+                      partition_columns={'day': 'varchar'})
+    assert 'prevents partition pruning' not in q
+    assert "CAST(DATE( current_date - INTERVAL '1' day) AS VARCHAR)" in q
+
+
+def test_partition_column_of_unknown_type_is_cast():
+    q = translate_sql("select datediff(day, '2020-01-01') from t", 'hive', 'presto', partition_columns=['day'])
+    assert "DATE_DIFF('day', DATE(day), DATE('2020-01-01'))" in q
+    assert 'Partition column day is cast as date' in q
+
+
+def test_query_log_skips_records_without_a_query_string(tmp_path):
+    log = tmp_path / 'log.jsonl'
+    log.write_text('{"query": null}\n{"query": 3}\n{"query": "select a from t"}\n{"query": "select a from t"}\n')
+    stats = translate_query_log(str(log), str(tmp_path / 'out.jsonl'), src='presto', dests=('hive',), n_jobs=1)
+    assert stats['invalid'] == 2
+    assert stats['written'] == 2 and stats['duplicates'] == 1
+    assert stats['latency']['translate']['total'] > 0
+
+
+def test_translate_file_with_default_number_of_jobs(tmp_path):
+    (tmp_path / 'in.sql').write_text("select a from t;\n-- done\nselect b from u;\n")
+    translate_file(str(tmp_path / 'in.sql'), str(tmp_path / 'out.sql'), 'presto', 'hive', n_jobs=None, batch_size=2)
+    assert (tmp_path / 'out.sql').read_text() == "SELECT a FROM t;\n-- done\nSELECT b FROM u;\n"
+
+
+def test_rule_timings_cover_the_translation():
+    from criteo_help import _translate_sql
+    q, replacements, warnings, session_parameters = _translate_sql("select datediff(a, b) from t -- c", 'hive', 'presto', timed=True)
+    labels = [label for label, seconds in replacements.timings]
+    assert labels[0] == 'other' and labels[-1] == 'other'
+    assert labels[1:-1] == [r[0] for r in replacements]
+
+
+def _hive_engine():
+    # connection factory standing in for Hive
+    import sqlite3
+    return sqlite3.connect(':memory:')
+
+
+def test_shared_stand_in_engine_is_inconclusive():
+    tables = {'t': [{'a': 1, 'b': 2}]}
+    report = validate_translations([{'query': 'select a / b from t', 'tables': tables}], 'hive', 'presto',
+                                   engines='sqlite', n_jobs=1)
+    assert report['status'] == {'inconclusive': 1}
+    assert report['failures'] == []
+    assert report['rules']['cast division as float'] == {'applied': 1, 'broken': [], 'inconclusive': [0]}
+
+
+def test_engines_per_language():
+    tables = {'t': [{'a': 1, 'b': 2}]}
+    report = validate_translations([{'query': 'select a + b from t', 'tables': tables}], 'hive', 'presto',
+                                   engines={'hive': _hive_engine, 'presto': 'sqlite'}, n_jobs=1)
+    assert report['status'] == {'passed': 1}
+    assert report['engines'] == {'hive': '_hive_engine', 'presto': 'sqlite'}
+
+
+def test_rule_triggers_after_formatting():
+    from criteo_help import register_rule, unregister_rule
+    register_rule('tag selects', pattern=r'^SELECT', replacement='SELECT /* tagged */', after='format', triggers=['select'])
+    try:
+        assert translate_sql('select a from t', 'presto', 'hive', verbose=False).strip() == 'SELECT /* tagged */ a FROM t'
+    finally:
+        unregister_rule('tag selects')
+
+
+def test_bracket_index_update_matches_rebuild():
+    from criteo_help import BracketIndex
+    q = "select f(a, g(b, 'x,(y'), [1, 2]), h(c) from t where k in (1, 2)"
+    index = BracketIndex(q)
+    edits = [("g(b, 'x,(y')", "coalesce(b, ')', c)"), ('h(c)', 'h'), ('a', 'date(a, 1)'), ('(1, 2)', "('a, b')"), ('b', 'b, d')]
+    for old, new in edits:
+        start = index.q.index(old)
+        index.replace(start, start + len(old), new)
+        rebuilt = BracketIndex(index.q)
+        assert index.close == rebuilt.close
+        assert index.commas == rebuilt.commas
+        assert index.literals == rebuilt.literals
+
+
+def test_varchar_casts_use_the_catalog(tmp_path):
+    import json
+    from criteo_help import SchemaCatalog
+    (tmp_path / 'catalog.json').write_text(json.dumps({'t': {'code': 'varchar(3)', 'name': 'varchar'}}))
+    catalog = SchemaCatalog(str(tmp_path / 'catalog.json'))
+    q = translate_sql('select cast(code as varchar(10)), cast(code as varchar(2)), cast(name as varchar), cast(name as varchar(5)) from t',
+                      'presto', 'hive', verbose=False, catalog=catalog)
+    assert q.strip() == 'SELECT code, CAST(code AS VARCHAR(2)), name, CAST(name AS VARCHAR(5)) FROM t'
+
+
+def test_interval_cast_stops_at_its_comparison():
+    q = translate_sql("select a from t join u on t.id = u.id where day = current_date - interval 1 day", 'hive', 'presto',
+                      verbose=False, partition_columns={'day': 'varchar'})
+    assert "ON t.id = u.id WHERE day = CAST(DATE( current_date - INTERVAL '1' day) AS VARCHAR)" in q
+    q = translate_sql("select a from t where x = 1 and day = date_sub(current_date, 1) - interval 1 day", 'hive', 'presto',
+                      verbose=False, partition_columns={'day': 'varchar'})
+    assert "WHERE x = 1 AND day = CAST(DATE( DATE_ADD('day', -1, DATE(current_date)) - INTERVAL '1' day) AS VARCHAR)" in q
+
+
+def test_optimize_presto():
+    q = "select 'count(distinct x)' as label, count(distinct y), collect_set(z) over (partition by k) from t"
+    applied = translate_sql(q, 'hive', 'presto', verbose=False, optimize='apply')
+    assert applied.strip() == "SELECT 'count(distinct x)' AS label, APPROX_DISTINCT(y), SET_AGG(z) OVER (PARTITION BY k) FROM t"
+    proposed = translate_sql(q, 'hive', 'presto', optimize='propose')
+    assert 'Hint: cheaper equivalent, count(distinct) -> approx_distinct() (1 occurrence(s))' in proposed
+    assert 'Hint: cheaper equivalent, array_distinct(array_agg() over window) -> set_agg() over window' in proposed
+    assert "COUNT(DISTINCT y), ARRAY_DISTINCT(ARRAY_AGG(z) OVER (PARTITION BY k))" in proposed
+
+
+def test_optimize_hive():
+    q = "select approx_percentile(x, 0.5) from t where b rlike '^ab' and s = 'b rlike ''^c'''"
+    applied = translate_sql(q, 'presto', 'hive', verbose=False, optimize='apply')
+    assert applied.strip() == "SELECT PERCENTILE_APPROX(x, 0.5, 1000) FROM t WHERE b LIKE 'ab%' AND s = 'b rlike ''^c'''"
+    proposed = translate_sql(q, 'presto', 'hive', optimize='propose')
+    assert "Hint: cheaper equivalent, x rlike '^prefix' -> x like 'prefix%' (1 occurrence(s))" in proposed
+    assert 'PERCENTILE_APPROX(x, 0.5) FROM t' in proposed
+
+
+def test_optimize_vertica():
+    q = "select count(distinct y), 'count(distinct x)' /* count(distinct z) */ from t where regexp_like(b, '^ab')"
+    applied = translate_sql(q, 'presto', 'vertica', verbose=False, optimize='apply')
+    assert applied.strip() == "SELECT APPROXIMATE_COUNT_DISTINCT(y), 'count(distinct x)' /* count(distinct z) */ FROM t WHERE b LIKE 'ab%'"
+    proposed = translate_sql(q, 'presto', 'vertica', optimize='propose')
+    assert 'count(distinct) -> approximate_count_distinct() (1 occurrence(s))' in proposed
+    assert "regexp_like(x, '^prefix') -> x like 'prefix%' (1 occurrence(s))" in proposed
+
+
+def test_translate_file_session_parameters_on_their_own_line(tmp_path):
+    (tmp_path / 'in.sql').write_text("set hive.exec.dynamic.partition=true;select a, count(*) from (select * from t) group by 1;"
+                                     "select a, count(*) from (select * from u) group by 1;")
+    totals, warnings = translate_file(str(tmp_path / 'in.sql'), str(tmp_path / 'out.sql'), 'presto', 'hive')
+    lines = (tmp_path / 'out.sql').read_text().split('\n')
+    assert lines[0] == 'SET hive.exec.dynamic.partition=true;'
+    assert lines[1] == lines[3] == 'SET hive.groupby.orderby.position.alias=true;'
+    assert totals['change hive session parameters to use column positions'] == 2
+
+
+_script = """-- nightly job
+set hive.exec.dynamic.partition=true;
+/* step 1; with a semicolon */
+select a, count(*) from (select * from t) group by 1;
+
+-- step 2; with a semicolon in the comment
+select date_diff('day', a, b), ';' from t;
+select cardinality(x) from u;
+select a, count(*) from (select * from u) group by 1
+"""
+
+
+def test_translate_script_in_order():
+    expected = """SET hive.groupby.orderby.position.alias=true;
+-- nightly job
+set hive.exec.dynamic.partition=true;
+/* step 1; with a semicolon */
+SELECT a, COUNT(*) FROM (SELECT * FROM t) GROUP BY *;
+
+-- step 2; with a semicolon in the comment
+SELECT -DATEDIFF(a, b), ';' FROM t;
+SELECT SIZE(x) FROM u;
+SELECT a, COUNT(*) FROM (SELECT * FROM u) GROUP BY *
+"""
+    for n_jobs in (1, 2):
+        script, totals, warnings = translate_script(_script, 'presto', 'hive', n_jobs=n_jobs, chunksize=1)
+        assert script == expected
+        assert script.count('position.alias') == 1
+        assert totals['change hive session parameters to use column positions'] == 2
+
+
+def test_translate_script_keeps_the_session_parameter_set_by_the_script():
+    for value in ('true', 'false'):
+        script, totals, warnings = translate_script(f'set hive.groupby.orderby.position.alias={value};\n' + _script, 'presto', 'hive')
+        assert script.startswith(f'set hive.groupby.orderby.position.alias={value};\n-- nightly job')
+        assert script.count('position.alias') == 1
+        assert any('position.alias' in w for w in warnings) == (value == 'false')
+
+
+def _counting_chunks(monkeypatch):
+    # count the queries sent to the translation
+    import criteo_help
+    calls = []
+    translate_chunk = criteo_help._translate_chunk
+    def counting(chunk, options=None):
+        calls.extend(chunk)
+        return translate_chunk(chunk, options)
+    monkeypatch.setattr(criteo_help, '_translate_chunk', counting)
+    return calls
+
+
+def test_translate_sql_column_list(monkeypatch):
+    from criteo_help import translate_sql_column
+    calls = _counting_chunks(monkeypatch)
+    result = translate_sql_column(['select size(a) from t', None, 'select size(a) from t', 'select 1'], 'hive', 'presto', n_jobs=1)
+    assert result['sql'] == ['SELECT CARDINALITY(a) FROM t', None, 'SELECT CARDINALITY(a) FROM t', 'SELECT 1']
+    assert result['size() -> cardinality()'] == [1, 0, 1, 0]
+    assert result['warnings'] == [[], [], [], []]
+    assert len(calls) == 3
+
+
+def test_translate_sql_column_with_src_and_dest_columns(monkeypatch):
+    from criteo_help import translate_sql_column
+    calls = _counting_chunks(monkeypatch)
+    queries = ['select cardinality(a) from t'] * 3
+    result = translate_sql_column(queries, ['presto', 'presto', 'presto'], ['hive', 'vertica', 'hive'], n_jobs=1, chunksize=1)
+    assert result['sql'] == ['SELECT SIZE(a) FROM t', 'SELECT ARRAY_LENGTH(a) FROM t', 'SELECT SIZE(a) FROM t']
+    assert len(calls) == 2
+
+
+def test_translate_sql_column_pandas(monkeypatch):
+    pd = pytest.importorskip('pandas')
+    from criteo_help import translate_sql_column
+    calls = _counting_chunks(monkeypatch)
+    queries = pd.Series(['select size(a) from t', None, 'select size(a) from t'], index=[10, 11, 12])
+    result = translate_sql_column(queries, 'hive', 'presto', n_jobs=1)
+    assert list(result.index) == [10, 11, 12]
+    assert result['sql'].isna().tolist() == [False, True, False]
+    assert result['sql'][10] == result['sql'][12] == 'SELECT CARDINALITY(a) FROM t'
+    assert len(calls) == 2
+    result = translate_sql_column(queries, 'hive', pd.Series(['presto', 'vertica', 'vertica'], index=[10, 11, 12]), n_jobs=1)
+    assert result['sql'][10] == 'SELECT CARDINALITY(a) FROM t' and result['sql'][12] == 'SELECT ARRAY_LENGTH(a) FROM t'
+    assert result['sql'].isna().tolist() == [False, True, False]
+
+
+def test_translate_sql_column_arrow(monkeypatch):
+    pa = pytest.importorskip('pyarrow')
+    from criteo_help import translate_sql_column
+    calls = _counting_chunks(monkeypatch)
+    queries = pa.chunked_array([['select size(a) from t', None], ['select size(a) from t', 'select 1']])
+    result = translate_sql_column(queries, 'hive', 'presto', n_jobs=1)
+    assert isinstance(result, pa.Table)
+    assert result['sql'].to_pylist() == ['SELECT CARDINALITY(a) FROM t', None, 'SELECT CARDINALITY(a) FROM t', 'SELECT 1']
+    assert result['size() -> cardinality()'].to_pylist() == [1, 0, 1, 0]
+    assert len(calls) == 3
+    result = translate_sql_column(pa.array(['select size(a) from t', None]), 'hive', pa.array(['presto', 'vertica']), n_jobs=1)
+    assert result['sql'].to_pylist() == ['SELECT CARDINALITY(a) FROM t', None]
+
+
+def test_rule_pipeline_without_rules_is_cached(monkeypatch):
+    import criteo_help
+    criteo_help._compiled_rules.clear()
+    translate_sql('select 1', 'presto', 'hive')
+    assert criteo_help._compiled_rules[('presto', 'hive')] is None
+    monkeypatch.setattr(criteo_help, '_compile_rules', lambda src, dest: pytest.fail('rules compiled again'))
+    translate_sql('select 2', 'presto', 'hive')
+
+
+def test_same_engine_for_both_languages_is_inconclusive():
+    tables = {'t': [{'a': 1, 'b': 2}]}
+    report = validate_translations([{'query': 'select a / b from t', 'tables': tables}], 'hive', 'presto',
+                                   engines={'hive': 'sqlite', 'presto': 'sqlite'}, n_jobs=1)
+    assert report['status'] == {'inconclusive': 1}